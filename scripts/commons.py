@@ -1,11 +1,18 @@
 import math
+import os
+import time
+import sqlite3
+import json
 import pandas as pd
 from textwrap import dedent
+from functools import lru_cache
+from collections import OrderedDict
 from pyproj import Geod
 import numpy as np
 import requests
 import matplotlib.pyplot as plt
 from scipy.integrate import quad
+from concurrent.futures import ThreadPoolExecutor
 
 
 ########## VARIABLES ##########
@@ -16,18 +23,34 @@ defaultShadedRatio = 0.5
 defaultShadeIrradiationRatio = 0.5
 defaultMaxSamplingDistance = 100 # in m
 ignoreBuffer = 4000 # in m
+contrastQuadratureOrder = 16 # Gauss-Legendre nodes per contrast integral (8 already agrees with quad to ~1e-12)
+minContrast = 0.02 # Below the Horizon, Michael Vollmer, 2020
 
 summitFile = '../data/clean/summits_prm.csv'
 pinnaclePointFile = '../data/results/pinnacle_points/prm/pinnacle_points.csv'
 patchDirectory = f'../data/patches/prm_{defaultLightCurvature}'
+summitIndexFile = '../data/index/summits_prm.npz'
 
 # summitFile = '../data/clean/summits_iso.csv'
 # pinnaclePointFile = '../data/results/pinnacle_points/iso/pinnacle_points.csv'
 # patchDirectory = f'../data/patches/iso_{defaultLightCurvature}'
+# summitIndexFile = '../data/index/summits_iso.npz'
 
 # summitFile = '../data/results/pinnacle_points/prm_iso/pinnacle_points_merged.csv'
 # pinnaclePointFile = '../data/results/pinnacle_points/prm_iso/pinnacle_points.csv'
 # patchDirectory = f'../data/patches/prm_iso_{defaultLightCurvature}'
+# summitIndexFile = '../data/index/summits_prm_iso.npz'
+
+# Compact dtypes of the summit tables, read and written with readSummits and writeSummits
+# Coordinates stay float64 (float32 is only good to ~1 m at 180 deg), isolations reach 2e7 m so they do too
+summitDtypes = {'summitId': 'int32',
+                'latitude': 'float64',
+                'longitude': 'float64',
+                'elevation': 'float32',
+                'prominence': 'float32',
+                'isolation': 'float64',
+                'candidate': 'bool',
+                'maxHorizonDistance': 'int32'}
 
 earthRadius = 6371146 # in m (Mean Sea Level, GPS, and the Geoid. Witold Fraczek 2003)
 atmosphereScaleHeight = 8500 # in m (https://web.archive.org/web/20250821225050/https://nssdc.gsfc.nasa.gov/planetary/factsheet/earthfact.html)
@@ -36,11 +59,51 @@ geod = Geod(ellps='sphere')
 
 apiRequestUrl = 'http://127.0.0.1:8080/v1/elevation'
 apiRequestLimit = 100
-session = requests.Session()
+apiMaxConcurrentRequests = 8
+apiMaxRetries = 5
+apiRetryBackoff = 0.5 # in s, doubled after every failed attempt
+apiRequestTimeout = 60 # in s
+apiClients = {} # Session and thread pool per process id, since neither survives a fork
+
+checkpointColumns = ['summitId', 'pinnacle', 'disqualifierId', 'complete'] # See recordVerdict
+
+# Lines of sight whose elevations are fetched together in isPinnaclePoint. The first possible disqualifiers are the most
+# likely to be in view, so batches start small and double after every batch with none in view
+minLosBatchSize = 1
+maxLosBatchSize = 16
+
+# Order possible disqualifiers are tested in: 'angle' (highest apparent elevation angle first) or 'distance' (closest first)
+disqualifierOrder = 'angle'
+# Possible disqualifiers behind the highest obstruction of an already obstructed line of sight, and below it, have the
+# sample of their own profile closest to that obstruction fetched first when they are in line with it to within this
+# cross-track distance (in m). The shadow is only a hint of where to look, a line of sight is never skipped because of it:
+# skipping shadowed summits outright (as first asked for) could wrongly keep a candidate, so probing replaced it on purpose.
+# 0 disables the probing and the shadow bookkeeping
+disqualifierShadowTolerance = 0
+
+# Sample strides used to look for an obvious obstruction before sampling every point, must end with 1
+progressiveStrides = [32, 1]
+assert(progressiveStrides[-1] == 1)
+
+# Where getElevations gets its elevations: 'api' (local Open-Meteo server) or 'dem' (local DEM tiles)
+elevationSource = 'api'
+# 1x1 deg .hgt tiles, e.g. N45W122.hgt: square grids with overlapping edges, 1201x1201 for 3 arc-seconds.
+# Copernicus GLO-90 GeoTIFFs are 1200 wide without the overlapping edge, and narrower above 50 deg, so they have to be
+# resampled onto that grid: gdal_translate -of SRTMHGT -outsize 1201 1201 -r bilinear in.tif N45W122.hgt
+demDirectory = '../data/dem/glo90'
+demTiles = {} # Memory-mapped DEM tiles keyed by their south-west corner, None where there is no tile (sea)
+
+# With the cache on, elevations are looked up at the nearest node of a grid with elevationCacheResolution spacing
+useElevationCache = False
+elevationCacheFile = '../data/cache/elevations.sqlite'
+elevationCacheResolution = 1/1200 # in deg, 3 arc-seconds like Copernicus GLO-90
+elevationCacheMemorySize = 256*1024**2 # in bytes, of the in-memory LRU in front of the SQLite file
+elevationCacheEntrySize = 150 # in bytes, an int node, a float elevation and their OrderedDict entry (measured with tracemalloc)
+elevationCaches = {} # ElevationCache per process id, since SQLite connections do not survive a fork
 
 """
 Patch Size Info:
-- Can't go below maxOffset = 6.614 = convertDistanceToDeltaLat(2*horizonDistance(everestElevation)), everestElevation = 8737.79
+- Can't go below maxOffset = 6.534 = convertDistanceToDeltaLat(2*horizonDistance(everestElevation)), everestElevation = 8737.79
   Otherwise patches that border the pole-patches would cross beyond the poles
 - Can only be an integer N where maxOffset < (90-N)/N < 90
 """
@@ -48,6 +111,38 @@ patchSize = 10
 allowedPatchSizes = [10, 15, 18, 30, 45]
 assert(patchSize in allowedPatchSizes)
 
+# Loaded patches are shared between candidates in the same patch, least recently used first out past the budget
+patchCacheSize = 4*1024**3 # in bytes
+patchCache = OrderedDict() # Patch and its size in bytes, keyed by patch bounds
+
+# How patches are saved: 'npy' (a directory of memory-mappable columns with a JSON header) or 'csv' (legacy)
+patchFormat = 'npy'
+patchMetadataLabels = {'Global Summits': 'numGlobalSummits',
+                       'Patch Summits (Inner)': 'numSummitsInner',
+                       'North (Inner)': 'northInner',
+                       'South (Inner)': 'southInner',
+                       'East (Inner)': 'eastInner',
+                       'West (Inner)': 'westInner',
+                       'North (Outer)': 'northOuter',
+                       'South (Outer)': 'southOuter',
+                       'East (Outer)': 'eastOuter',
+                       'West (Outer)': 'westOuter',
+                       'Lat Offset': 'latOffset',
+                       'Lng Offset': 'lngOffset',
+                       'Offset Distance': 'offsetDistance',
+                       'Buffer Max Elevation': 'bufferMaxElevation',
+                       'Buffer Iterations': 'bufferIterations'}
+
+# How far the outer bounds of a patch reach: 'global' pads every patch for the highest summit on Earth,
+# 'adaptive' shrinks the padding to the highest summit that can still disqualify one of its inner summits
+patchBufferMode = 'adaptive'
+patchBufferMargin = 100 # in m, added to every offset so the rounded distances of getPossibleDisqualifiers stay inside
+
+# Where isPinnaclePoint looks for possible disqualifiers: 'patch' (patch_maker.py) or 'index' (index_maker.py)
+neighbourSource = 'patch'
+summitIndexCellSize = 1 # in deg
+summitIndex = None # Loaded on first use by getSummitIndex()
+
 
 ########## FUNCTIONS ##########
 
@@ -66,26 +161,325 @@ def horizonDistance(height, lightCurvature=defaultLightCurvature):
         return math.sqrt(2*(lightCurvature/(lightCurvature-1))*earthRadius*height)
     return 0
 
-def getElevations(latitudes, longitudes):
+def horizonDistances(heights, lightCurvature=defaultLightCurvature):
+    heights = np.maximum(np.asarray(heights, dtype=float), 0)
+    return np.sqrt(2*(lightCurvature/(lightCurvature-1))*earthRadius*heights)
+
+def getApparentElevationAngles(observerElevation, elevations, distances, lightCurvature=defaultLightCurvature):
+    # Small angle elevation above the observer's horizontal, light travels straight over an earth of radius R*C/(C-1)
+    effectiveEarthRadius = earthRadius*lightCurvature/(lightCurvature-1)
+    distances = np.asarray(distances, dtype=float)
+    return (np.asarray(elevations, dtype=float) - observerElevation)/distances - distances/(2*effectiveEarthRadius)
+
+# Geometry of lines of sight in the plane through both end points and the earth's centre, observer on the x axis
+# Every argument can be an array, so one call covers the samples of one line of sight or a line of sight each
 
-    elevations = []
-    for i in range(0, len(latitudes), apiRequestLimit):
-        chunkLatitudes = latitudes[i : i+apiRequestLimit]
-        chunkLongitudes = longitudes[i : i+apiRequestLimit]
+def getLightCircles(observerElevations, targetElevations, surfaceDistances, lightCurvature=defaultLightCurvature):
+
+    h1 = np.asarray(observerElevations, dtype=float)
+    h2 = np.asarray(targetElevations, dtype=float)
+    D = np.asarray(surfaceDistances, dtype=float)
+    R = earthRadius
+    C = lightCurvature
     
-        params = {'latitude': ','.join(map(str, chunkLatitudes)),
-                  'longitude': ','.join(map(str, chunkLongitudes))}
+    phi = D/R
+
+    x1 = R + h1
+    y1 = 0
+
+    x2 = (R+h2)*np.cos(phi)
+    y2 = (R+h2)*np.sin(phi)
+
+    d = np.sqrt((x2-x1)**2 + (y2-y1)**2)
 
-        response = session.get(apiRequestUrl, params=params)
+    RL = C*R
+
+    Z = np.sqrt(RL**2 - (d/2)**2)
+
+    Mx = (x1+x2)/2 - Z*((y2-y1)/d)
+    My = (y1+y2)/2 + Z*((x2-x1)/d)
+
+    return Mx, My, RL
+
+def getLightDistancesFromCentre(lightCircles, x):
+
+    Mx, My, RL = lightCircles
     
-        if response.status_code == 200:
-            data = response.json()
-            elevations.extend(data['elevation'])
+    theta = np.asarray(x)/earthRadius
+
+    projection = Mx*np.cos(theta) + My*np.sin(theta)
+    L0 = projection + np.sqrt(projection**2 - (Mx**2 + My**2 - RL**2))
+
+    return L0
+
+def getLightElevations(lightCircles, x):
+    return getLightDistancesFromCentre(lightCircles, x) - earthRadius
+
+def getStraightElevations(observerElevations, targetElevations, surfaceDistances, x):
+
+    h1 = np.asarray(observerElevations, dtype=float)
+    h2 = np.asarray(targetElevations, dtype=float)
+    D = np.asarray(surfaceDistances, dtype=float)
+    R = earthRadius
+    phi = D/R
+    theta = np.asarray(x)/R
+
+    x1 = R + h1
+    y1 = 0
+    x2 = (R + h2)*np.cos(phi)
+    y2 = (R + h2)*np.sin(phi)
+
+    m = np.divide(x2 - x1, y2 - y1, out=np.ones(np.broadcast(x2, y2).shape), where=y2 != y1)
+        
+    b = x1
+
+    r = b/(np.cos(theta) - m*np.sin(theta))
+
+    return r - R
+
+def getElevations(latitudes, longitudes):
+    if useElevationCache:
+        return getElevationCache().getElevations(latitudes, longitudes)
+    return getUncachedElevations(latitudes, longitudes)
+
+def getElevationCache():
+    processId = os.getpid()
+    if processId not in elevationCaches:
+        elevationCaches[processId] = ElevationCache()
+    return elevationCaches[processId]
+
+def getUncachedElevations(latitudes, longitudes):
+    if elevationSource == 'dem':
+        return getDemElevations(latitudes, longitudes)
+    return getApiElevations(latitudes, longitudes)
+
+def getApiClient():
+    processId = os.getpid()
+    if processId not in apiClients:
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=apiMaxConcurrentRequests))
+        apiClients[processId] = (session, ThreadPoolExecutor(apiMaxConcurrentRequests))
+    return apiClients[processId]
+
+def getApiElevationChunk(chunkLatitudes, chunkLongitudes):
+
+    session, _ = getApiClient()
+
+    params = {'latitude': ','.join(map(str, chunkLatitudes)),
+              'longitude': ','.join(map(str, chunkLongitudes))}
+
+    for attempt in range(apiMaxRetries + 1):
+
+        try:
+            response = session.get(apiRequestUrl, params=params, timeout=apiRequestTimeout)
+
+            if response.status_code == 200:
+                elevations = response.json()['elevation']
+                if len(elevations) == len(chunkLatitudes):
+                    return elevations
+                error = f'{len(elevations)} elevations returned for {len(chunkLatitudes)} points'
+            else:
+                error = f'{response.status_code} {response.text}'
+
+        except requests.RequestException as exception:
+            error = exception
+
+        if attempt < apiMaxRetries:
+            print(f'Error: {error}, retrying')
+            time.sleep(apiRetryBackoff * 2**attempt)
+
+    # Dropping a chunk would misalign every elevation after it
+    raise RuntimeError(f'Elevation request failed after {apiMaxRetries + 1} attempts: {error}')
+
+def getApiElevations(latitudes, longitudes):
+
+    chunks = [(latitudes[i : i+apiRequestLimit], longitudes[i : i+apiRequestLimit]) 
+              for i in range(0, len(latitudes), apiRequestLimit)]
+
+    if len(chunks) > 1:
+        _, executor = getApiClient()
+        chunkElevations = executor.map(lambda chunk: getApiElevationChunk(*chunk), chunks)
+    else:
+        chunkElevations = [getApiElevationChunk(*chunk) for chunk in chunks]
+
+    # map keeps the chunk order, so elevations always line up with the input
+    return np.array([elevation for elevations in chunkElevations for elevation in elevations], dtype=float)
+
+def getDemTileFileName(tileLat, tileLng):
+    latPrefix = 'N' if tileLat >= 0 else 'S'
+    lngPrefix = 'E' if tileLng >= 0 else 'W'
+    return f'{latPrefix}{abs(tileLat):02d}{lngPrefix}{abs(tileLng):03d}.hgt'
+
+def getDemTile(tileLat, tileLng):
+    if (tileLat, tileLng) not in demTiles:
+        tilePath = f'{demDirectory}/{getDemTileFileName(tileLat, tileLng)}'
+
+        if os.path.exists(tilePath):
+            # HGT tiles are square grids of big-endian int16, north row first, with overlapping edges
+            fileSize = os.path.getsize(tilePath)
+            tileSize = math.isqrt(fileSize // 2)
+            if tileSize < 2 or tileSize*tileSize*2 != fileSize:
+                raise ValueError(f'{tilePath} is not a square HGT tile ({fileSize} bytes), see demDirectory for how to resample it')
+            demTiles[(tileLat, tileLng)] = np.memmap(tilePath, dtype='>i2', mode='r', shape=(tileSize, tileSize))
         else:
-            print('Error:', response.status_code, response.text)
+            demTiles[(tileLat, tileLng)] = None
+
+    return demTiles[(tileLat, tileLng)]
+
+def getDemElevations(latitudes, longitudes):
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = (np.asarray(longitudes, dtype=float) + 180) % 360 - 180
+
+    tileLats = np.floor(latitudes).astype(int)
+    tileLngs = np.floor(longitudes).astype(int)
+    tileKeys = (tileLats + 90)*360 + (tileLngs + 180)
+
+    elevations = np.zeros(len(latitudes))
+    for tileKey in np.unique(tileKeys):
+        inTile = tileKeys == tileKey
+        tileLat = tileKey//360 - 90
+        tileLng = tileKey%360 - 180
+
+        tile = getDemTile(tileLat, tileLng)
+        if tile is None:
+            continue
+
+        samplesPerDeg = tile.shape[0] - 1
+        rows = (tileLat + 1 - latitudes[inTile])*samplesPerDeg
+        cols = (longitudes[inTile] - tileLng)*samplesPerDeg
+
+        row0 = np.clip(np.floor(rows).astype(int), 0, samplesPerDeg-1)
+        col0 = np.clip(np.floor(cols).astype(int), 0, samplesPerDeg-1)
+        rowFrac = rows - row0
+        colFrac = cols - col0
+
+        corners = np.stack([tile[row0, col0], tile[row0, col0+1], tile[row0+1, col0], tile[row0+1, col0+1]]).astype(float)
+        corners[corners == -32768] = 0 # Voids
+
+        elevations[inTile] = ((1-rowFrac)*((1-colFrac)*corners[0] + colFrac*corners[1]) 
+                              + rowFrac*((1-colFrac)*corners[2] + colFrac*corners[3]))
 
     return elevations
 
+@lru_cache
+def getQuadratureNodes(order):
+    return np.polynomial.legendre.leggauss(order)
+
+def getDistances(latitude, longitude, latitudes, longitudes):
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+
+    # One vectorized great-circle call on the same sphere as Summit.getDistanceTo
+    _, _, distances = geod.inv(longitudes, latitudes,
+                               np.full(longitudes.shape, longitude, dtype=float),
+                               np.full(latitudes.shape, latitude, dtype=float))
+    return distances
+
+def getAzimuths(latitude, longitude, latitudes, longitudes):
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+
+    # Forward azimuths from the fixed point to every point, in deg
+    azimuths, _, _ = geod.inv(np.full(longitudes.shape, longitude, dtype=float),
+                              np.full(latitudes.shape, latitude, dtype=float),
+                              longitudes, latitudes)
+    return azimuths
+
+def getSummitDtypes(columns):
+    return {column: summitDtypes[column] for column in columns if column in summitDtypes}
+
+def readSummits(fileName, **kwargs):
+    # Columns missing from summitDtypes keep the dtypes pandas gives them
+    return pd.read_csv(fileName, dtype=summitDtypes, **kwargs)
+
+def writeSummits(summits, fileName, **kwargs):
+    summits.astype(getSummitDtypes(summits.columns)).to_csv(fileName, **kwargs)
+
+def getGreatCirclePoints(latitudes1, longitudes1, latitudes2, longitudes2, pairIds, fractions):
+
+    # Points a fraction of the way along the great circles from 1 to 2 of their pairs, interpolated between unit vectors
+    # This is exact on the sphere of geod and only needs the trigonometry of the end points once per pair
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(values, dtype=float)) for values in (latitudes1, longitudes1, latitudes2, longitudes2))
+    start = np.array([np.cos(lat1)*np.cos(lng1), np.cos(lat1)*np.sin(lng1), np.sin(lat1)])
+    end = np.array([np.cos(lat2)*np.cos(lng2), np.cos(lat2)*np.sin(lng2), np.sin(lat2)])
+
+    angles = np.arctan2(np.linalg.norm(np.cross(start, end, axis=0), axis=0), np.sum(start*end, axis=0))
+    sampleAngles = angles[pairIds]
+    sampleAngleSines = np.sin(angles)[pairIds]
+    startWeights = np.sin((1 - fractions)*sampleAngles)/sampleAngleSines
+    endWeights = np.sin(fractions*sampleAngles)/sampleAngleSines
+    x, y, z = startWeights*start[:, pairIds] + endWeights*end[:, pairIds]
+
+    return np.degrees(np.arctan2(z, np.hypot(x, y))), np.degrees(np.arctan2(y, x))
+
+def loadVerdicts(checkpointFile):
+    # A crash can leave a torn line that still parses (e.g. a truncated disqualifierId), so a verdict
+    # only counts when every field is well formed and the line reached its last column
+    verdicts = pd.read_csv(checkpointFile, dtype=str, keep_default_na=False, on_bad_lines='skip')
+    isComplete = ((verdicts.complete == 'True')
+                  & verdicts.summitId.str.fullmatch(r'-?\d+')
+                  & verdicts.pinnacle.isin(['True', 'False'])
+                  & verdicts.disqualifierId.str.fullmatch(r'(-?\d+)?'))
+    verdicts = verdicts[isComplete]
+    return dict(zip(verdicts.summitId.astype(int), verdicts.pinnacle == 'True'))
+
+def recordVerdict(checkpoint, summitId, isPinnaclePoint, disqualifierId):
+    disqualifierId = '' if disqualifierId is None else disqualifierId
+
+    # One short write per line keeps appends from parallel workers whole, the last column marks the line as complete
+    checkpoint.write(f'{summitId},{isPinnaclePoint},{disqualifierId},True\n')
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+def findPinnaclePointsInPatch(patchBounds, candidates, checkpointFile=None):
+
+    # Each worker loads its patch once and reuses it for every candidate inside it
+    patch = Patch(*patchBounds) if neighbourSource == 'patch' else None
+    checkpoint = open(checkpointFile, 'a') if checkpointFile else None
+    startCacheCounts = getElevationCache().getCounts() if useElevationCache else None
+
+    results = []
+    for candidate in candidates.itertuples():
+        observer = Summit(summitId = candidate.summitId,
+                          latitude = candidate.latitude,
+                          longitude = candidate.longitude,
+                          elevation = candidate.elevation)
+
+        candidateIsPinnaclePoint = observer.isPinnaclePoint(patch)
+        results.append((candidate.Index, candidateIsPinnaclePoint, observer.disqualifierId))
+
+        if checkpoint:
+            recordVerdict(checkpoint, candidate.summitId, candidateIsPinnaclePoint, observer.disqualifierId)
+
+    if checkpoint:
+        checkpoint.close()
+
+    # Cache lookups of this call, so the parent can add up the statistics of every worker
+    cacheCounts = getElevationCache().getCounts() - startCacheCounts if useElevationCache else None
+
+    return results, cacheCounts
+
+def getCachedPatch(patchBounds):
+
+    if patchBounds in patchCache:
+        patchCache.move_to_end(patchBounds)
+        return patchCache[patchBounds][0]
+
+    patch = Patch(*patchBounds)
+    patchCache[patchBounds] = (patch, patch.getMemoryUsage())
+
+    # The newest patch always stays, even when it alone is over budget
+    while len(patchCache) > 1 and sum(size for _, size in patchCache.values()) > patchCacheSize:
+        patchCache.popitem(last=False)
+
+    return patch
+
+def getSummitIndex():
+    global summitIndex
+    if summitIndex is None:
+        summitIndex = SummitIndex()
+    return summitIndex
+
 
 ########## CLASSES ##########
 
@@ -116,66 +510,161 @@ class Summit(Point):
         self.summitId = summitId
         self.prominence = prominence
         self.isolation = isolation
+        self.disqualifierId = None # Set by isPinnaclePoint to the summitId of the summit in view
 
     def getMaxHorizonDistance(self):
         return horizonDistance(self.elevation)
 
-    def getPatch(self):
+    def getPatchBounds(self):
         poleLatitude = getPoleLatitude()
         
         if self.latitude >= poleLatitude:
-            return Patch(90, poleLatitude)
+            return (90, poleLatitude)
         
         elif self.latitude < -poleLatitude:
-            return Patch(-poleLatitude, -90)
+            return (-poleLatitude, -90)
         
         else:
             # Round down to nearst multiple of patchSize
             latMin = int((self.latitude // patchSize) * patchSize)
             lngMin = int((self.longitude // patchSize) * patchSize)
     
-            return Patch(latMin+patchSize, latMin, lngMin+patchSize, lngMin)
+            return (latMin+patchSize, latMin, lngMin+patchSize, lngMin)
+
+    def getPatch(self):
+        return getCachedPatch(self.getPatchBounds())
 
     def getDistanceTo(self, summit):
-        return geod.line_length([summit.longitude, self.longitude], [summit.latitude, self.latitude])
+        _, _, distance = geod.inv(summit.longitude, summit.latitude, self.longitude, self.latitude)
+        return distance
+
+    def getPossibleDisqualifiers(self, patch=None):
+
+        if neighbourSource == 'index':
+            index = getSummitIndex()
+            searchRadius = self.getMaxHorizonDistance() + index.maxHorizonDistance
+            higherSummits, distances = index.query(self.latitude, self.longitude, searchRadius, self.elevation)
+
+            isNotSelf = higherSummits.summitId.to_numpy() != self.summitId
+            higherSummits = higherSummits[isNotSelf]
+            distanceFromCandidate = np.round(distances[isNotSelf])
+
+        else:
+            if patch is None:
+                patch = self.getPatch()
+
+            # Cached patches are shared between candidates, so summitsOuter is only ever read here
+            patchSummits = patch.summitsOuter
+
+            # Cheap elevation mask first so distances are only computed for higher summits
+            isHigher = (patchSummits.summitId.to_numpy() != self.summitId) & (patchSummits.elevation.to_numpy() > self.elevation)
+            higherSummits = patchSummits[isHigher]
+
+            distanceFromCandidate = np.round(getDistances(self.latitude, self.longitude,
+                                                          higherSummits.latitude.to_numpy(),
+                                                          higherSummits.longitude.to_numpy()))
+
+        isInMhdRange = distanceFromCandidate < higherSummits.maxHorizonDistance.to_numpy() + self.getMaxHorizonDistance()
+        return higherSummits[isInMhdRange].assign(distanceFromCandidate=distanceFromCandidate[isInMhdRange])
 
-    def isPinnaclePoint(self):
+    def isPinnaclePoint(self, patch=None):
 
         # Candidates are Pinnacle Points until proven guilty
         isPinnaclePoint = True
         
-        patchSummits = self.getPatch().summitsOuter
-        patchSummits['distanceFromCandidate'] = round(patchSummits.apply(lambda patchSummit: round(self.getDistanceTo(patchSummit)), axis=1))        
-        patchSummitsInMhdRange = patchSummits.query('(summitId != @self.summitId) & '
-                                                    '(elevation > @self.elevation) & '
-                                                    '(distanceFromCandidate < maxHorizonDistance + @self.getMaxHorizonDistance())')
+        patchSummitsInMhdRange = self.getPossibleDisqualifiers(patch)
     
         print(f'Potential Disqualifying Summits: {len(patchSummitsInMhdRange)}')
-        
-        patchSummitsInMhdRange = patchSummitsInMhdRange.sort_values('distanceFromCandidate')
-    
-        for j, summit in enumerate(patchSummitsInMhdRange.itertuples()):
-    
-            target = Summit(latitude = summit.latitude,
-                            longitude = summit.longitude,
-                            elevation = summit.elevation)
 
-            candidateLineOfSight = LineOfSight(self, target)
+        patchSummitsInMhdRange = patchSummitsInMhdRange.assign(
+            azimuth = getAzimuths(self.latitude, self.longitude, patchSummitsInMhdRange.latitude, patchSummitsInMhdRange.longitude),
+            apparentAngle = getApparentElevationAngles(self.elevation, patchSummitsInMhdRange.elevation, patchSummitsInMhdRange.distanceFromCandidate))
+
+        # The summits that look highest from the candidate are the most likely to be in view
+        if disqualifierOrder == 'angle':
+            patchSummitsInMhdRange = patchSummitsInMhdRange.sort_values('apparentAngle', ascending=False, kind='stable')
+        else:
+            patchSummitsInMhdRange = patchSummitsInMhdRange.sort_values('distanceFromCandidate')
+
+        # Azimuth, distance and apparent angle of the highest obstruction on every obstructed line of sight so far
+        shadows = np.empty((0, 3))
+        numTested = 0
+        numProbed = 0
+
+        # Up to losBatchSize lines of sight per elevation request
+        summits = list(patchSummitsInMhdRange.itertuples())
+        position = 0
+        losBatchSize = minLosBatchSize
+        while position < len(summits):
+
+            summitBatch = summits[position : position+losBatchSize]
+            position += len(summitBatch)
 
-            candidateLineOfSight.processFullLineOfSight()
+            probeDistances = None
+            if disqualifierShadowTolerance > 0:
+                probeDistances = np.array([self.getShadowDistance(summit, shadows) for summit in summitBatch])
+                numProbed += int((~np.isnan(probeDistances)).sum())
+
+            targets = Point(latitude = np.array([summit.latitude for summit in summitBatch]),
+                            longitude = np.array([summit.longitude for summit in summitBatch]),
+                            elevation = np.array([summit.elevation for summit in summitBatch], dtype=float))
+
+            candidateLinesOfSight = LineOfSightBatch(self, targets)
+
+            candidateLinesOfSight.process(progressiveStrides, probeDistances)
+            isInView = candidateLinesOfSight.isValid()
+
+            for j, summit in enumerate(summitBatch):
+
+                numTested += 1
     
-            if candidateLineOfSight.isValid():
+                if isInView[j]:
     
-                print(f'Tested Potential Disqualifying Summits: {j+1}')
-                print(f'In view of {summit.latitude}, {summit.longitude} ({round(summit.elevation)} m) {round(summit.distanceFromCandidate/1000)} km away')
-                
-                isPinnaclePoint = False
+                    print(f'Tested Potential Disqualifying Summits: {numTested}')
+                    print(f'In view of {summit.latitude}, {summit.longitude} ({round(summit.elevation)} m) {round(summit.distanceFromCandidate/1000)} km away')
+                    
+                    isPinnaclePoint = False
+                    self.disqualifierId = summit.summitId
+                    break
+
+            if not isPinnaclePoint:
                 break
 
+            # Every line of sight of the batch is obstructed, their obstructions cast the shadows probed in later batches
+            if disqualifierShadowTolerance > 0:
+                obstructionDistances, obstructionElevations = candidateLinesOfSight.getObstructionPoints()
+                isObstructed = ~np.isnan(obstructionDistances)
+                shadowAngles = getApparentElevationAngles(self.elevation, obstructionElevations[isObstructed], obstructionDistances[isObstructed])
+                azimuths = np.array([summit.azimuth for summit in summitBatch])
+                shadows = np.vstack([shadows, np.column_stack([azimuths[isObstructed], obstructionDistances[isObstructed], shadowAngles])])
+
+            losBatchSize = min(2*losBatchSize, maxLosBatchSize)
+
+        if numProbed > 0:
+            print(f'Potential Disqualifying Summits Probed In Shadow: {numProbed}')
+
         print(f'Pinnacle Point: {isPinnaclePoint}')
 
         return isPinnaclePoint
 
+    def getShadowDistance(self, summit, shadows):
+        # Distance from the candidate of the highest obstruction the summit is in the shadow of, nan if there is none
+        if len(shadows) == 0:
+            return np.nan
+
+        shadowAzimuths, shadowDistances, shadowAngles = shadows.T
+        azimuthDifferences = np.radians((summit.azimuth - shadowAzimuths + 180) % 360 - 180)
+
+        # The obstruction has to be in front of the summit, outside of its ignoreBuffer, and above the light to it
+        isInLine = (np.abs(azimuthDifferences) < math.pi/2) & (shadowDistances*np.abs(np.sin(azimuthDifferences)) <= disqualifierShadowTolerance)
+        isInFront = shadowDistances < summit.distanceFromCandidate - ignoreBuffer
+        isBelow = summit.apparentAngle < shadowAngles
+
+        isInShadow = isInLine & isInFront & isBelow
+        if not isInShadow.any():
+            return np.nan
+        return shadowDistances[isInShadow][np.argmax(shadowAngles[isInShadow])]
+
 class LosPoint(Point):
 
     def __init__(self,
@@ -218,96 +707,77 @@ class LineOfSight():
         self.lightCurvature = lightCurvature
         self.scatterCoef0 = scatterCoef0
         self.minSamplingDistance = minSamplingDistance
-        self.surfaceDistance = geod.line_length([self.observer.longitude, self.target.longitude], [self.observer.latitude, self.target.latitude])
+        self.surfaceDistance = geod.inv(self.observer.longitude, self.observer.latitude, self.target.longitude, self.target.latitude)[2]
         self.shadedRatio = shadedRatio
         self.shadeIrradiationRatio = shadeIrradiationRatio
         self.numSamples = math.ceil(self.observer.getDistanceTo(self.target)/minSamplingDistance)
-        self.losPoints = []
+        self.batch = None
+        self.clearProfile()
+        self.lightCircle = None
 
-    def processFullLineOfSight(self):
-        
-        lngLats = geod.npts(self.observer.longitude, self.observer.latitude, 
-                            self.target.longitude, self.target.latitude, 
-                            self.numSamples)
-
-        latitudes = np.array(lngLats)[:, 1]
-        longitudes = np.array(lngLats)[:, 0]
-
-        elevations = getElevations(latitudes, longitudes)
-    
-        latitudes = np.concatenate([[self.observer.latitude], latitudes, [self.target.latitude]])
-        longitudes = np.concatenate([[self.observer.longitude], longitudes, [self.target.longitude]])
-        elevations = np.concatenate([[self.observer.elevation], elevations, [self.target.elevation]])
+    def getBatch(self):
 
-        surfaceDistances = []
-        for i, latitude in enumerate(latitudes):
-            longitude = longitudes[i]
-            surfaceDistances.append(geod.line_length([self.observer.longitude, longitude], [self.observer.latitude, latitude]))
+        # The profile and contrast are worked out by a LineOfSightBatch of one, built when first needed
+        if self.batch is None:
+            self.batch = LineOfSightBatch(self.observer, self.target, self.lightCurvature, self.scatterCoef0, 
+                                          self.minSamplingDistance, self.shadedRatio, self.shadeIrradiationRatio)
 
-        anglesBetweenObserverAndLosPoints = np.array(surfaceDistances)/earthRadius
-        xDistances = earthRadius * np.sin(anglesBetweenObserverAndLosPoints)
-        dropFromCurvature = earthRadius * (1 - np.cos(anglesBetweenObserverAndLosPoints))
-        yHeights = elevations - dropFromCurvature - elevations[0]
-
-        angleBelowHorizontal = -np.arctan(yHeights[-1]/xDistances[-1])
-    
-        rotationMatrix = np.array([[math.cos(angleBelowHorizontal), -math.sin(angleBelowHorizontal)],
-                                   [math.sin(angleBelowHorizontal),  math.cos(angleBelowHorizontal)]])
-        
-        rotatedPoints = rotationMatrix @ np.array([xDistances, yHeights])
-        straightDistances = rotatedPoints[0]
-        groundHeights = rotatedPoints[1]
+        return self.batch
 
-        distanceToTarget = straightDistances[-1]
-        gamma = (self.lightCurvature*earthRadius)*(self.lightCurvature*earthRadius) - (distanceToTarget)*(distanceToTarget)
-        lightHeights = np.sqrt(gamma + straightDistances*(distanceToTarget - straightDistances)) - np.sqrt(gamma)
-        
-        self.losPoints = [LosPoint(latitude, longitude, elevation, surfaceDistance, straightDistance, self.scatterCoef0, lightHeight, groundHeight) 
-                          for (latitude, longitude, elevation, surfaceDistance, straightDistance, lightHeight, groundHeight) 
-                          in zip(latitudes, longitudes, elevations, surfaceDistances, straightDistances, lightHeights, groundHeights)]
+    def processFullLineOfSight(self):
+        batch = self.getBatch()
+        batch.fetchSamples(np.flatnonzero(np.isnan(batch.sampleElevations)))
+        self.setProfile()
+
+    def processProgressiveLineOfSight(self):
+        self.getBatch().process(progressiveStrides)
+        self.setProfile()
+
+    def setProfile(self):
+        (self.latitudes, self.longitudes, self.elevations, self.surfaceDistances, 
+         self.straightDistances, self.lightHeights, self.groundHeights) = self.getBatch().getProfile(0)
+
+    def clearProfile(self):
+        self.latitudes = None
+        self.longitudes = None
+        self.elevations = None
+        self.surfaceDistances = None
+        self.straightDistances = None
+        self.lightHeights = None
+        self.groundHeights = None
+
+    # The profile is kept as arrays, points are only built for callers that want them
+    @property
+    def losPoints(self):
+        if self.elevations is None:
+            return []
+        return [LosPoint(latitude, longitude, elevation, surfaceDistance, straightDistance, self.scatterCoef0, lightHeight, groundHeight) 
+                for (latitude, longitude, elevation, surfaceDistance, straightDistance, lightHeight, groundHeight) 
+                in zip(self.latitudes, self.longitudes, self.elevations, self.surfaceDistances, self.straightDistances, self.lightHeights, self.groundHeights)]
     
     def getStraightDistance(self):
-        return self.losPoints[-1].straightDistance
+        return self.straightDistances[-1]
     
     def getLightDistance(self):
-        dx = np.diff([point.straightDistance for point in self.losPoints])
-        dy = np.diff([point.lightHeight for point in self.losPoints])
+        dx = np.diff(self.straightDistances)
+        dy = np.diff(self.lightHeights)
         return np.hypot(dx, dy).sum()
 
     def isInPossibleRange(self):
         return self.observer.getMaxHorizonDistance() + self.target.getMaxHorizonDistance() > self.surfaceDistance
 
-    def isObstructed(self):        
-        return not all(losPoint.groundHeight < losPoint.lightHeight 
-                       for losPoint 
-                       in self.losPoints
-                       if losPoint.straightDistance > ignoreBuffer and losPoint.straightDistance < self.getStraightDistance()-ignoreBuffer)
-
-    def getStraightElelvation(self, x):
-
-        h1 = self.observer.elevation
-        h2 = self.target.elevation
-        D = self.surfaceDistance
-        R = earthRadius
-        phi = D/R
-        theta = x/R
-
-        x1 = R + h1
-        y1 = 0
-        x2 = (R + h2)*math.cos(phi)
-        y2 = (R + h2)*math.sin(phi)
-
-        if y2 != y1:
-            m = (x2 - x1)/(y2 - y1)
-        else:
-            m=1
-            
-        b = x1
-        y = (x-b)/m
+    def isObstructed(self):
+        return bool(self.getBatch().isObstructed()[0])
 
-        r = b/(math.cos(theta) - m*math.sin(theta))
+    def getObstructionPoint(self):
+        # Surface distance and elevation of the sample rising furthest above the light, None when unobstructed
+        obstructionDistances, obstructionElevations = self.getBatch().getObstructionPoints()
+        if np.isnan(obstructionDistances[0]):
+            return None
+        return obstructionDistances[0], obstructionElevations[0]
 
-        return r - R
+    def getStraightElelvation(self, x):
+        return getStraightElevations(self.observer.elevation, self.target.elevation, self.surfaceDistance, x)
     
     def getLightLength(self, x1, x2, h=1e-6):
         
@@ -323,67 +793,48 @@ class LineOfSight():
     def derivative(self, function, x, h=1e-6):
         return (function(x + h) - function(x - h)) / (2*h)
 
-    def getLightDistanceFromCentre(self, x):
+    def getLightCircle(self):
 
-        h1 = self.observer.elevation
-        h2 = self.target.elevation
-        D = self.surfaceDistance
-        R = earthRadius
-        C = self.lightCurvature
-        
-        theta = x/R
-        phi = D/R
-    
-        x1 = R + h1
-        y1 = 0
-    
-        x2 = (R+h2)*math.cos(phi)
-        y2 = (R+h2)*math.sin(phi)
-    
-        d = math.sqrt((x2-x1)**2 + (y2-y1)**2)
-    
-        RL = C*R
-    
-        Z = math.sqrt(RL**2 - (d/2)**2)
-    
-        Mx = (x1+x2)/2 - Z*((y2-y1)/d)
-        My = (y1+y2)/2 + Z*((x2-x1)/d)
-    
-        L0 = (Mx*math.cos(theta)+My*math.sin(theta)) + math.sqrt((Mx*math.cos(theta) + My*math.sin(theta))**2 - (Mx**2 + My**2 - RL**2))
+        # The light arc only depends on the end points, so its centre is computed once per line of sight
+        if self.lightCircle is None:
+            self.lightCircle = getLightCircles(self.observer.elevation, self.target.elevation, self.surfaceDistance, self.lightCurvature)
+
+        return self.lightCircle
 
-        return L0
+    def getLightDistanceFromCentre(self, x):
+        return getLightDistancesFromCentre(self.getLightCircle(), x)
 
     def getLightElevation(self, x):
-        
-        return self.getLightDistanceFromCentre(x) - earthRadius
+        return getLightElevations(self.getLightCircle(), x)
 
     def getScatterCoef(self, x):
-        return self.scatterCoef0 * math.exp(-self.getLightElevation(x)/atmosphereScaleHeight)
+        return self.scatterCoef0 * np.exp(-self.getLightElevation(x)/atmosphereScaleHeight)
 
     def getContrast(self):
+        return self.getBatch().getContrasts()[0]
+
+    # Adaptive quadrature reference for checking contrastQuadratureOrder
+    def getQuadContrast(self):
 
         d1 = self.surfaceDistance * self.shadedRatio
-        d2 = self.surfaceDistance * (1 - self.shadedRatio)
 
         scatterCoefIntResult1, error1 = quad(lambda x: self.getScatterCoef(x), 0, d1)   
         scatterCoefIntResult2, error2 = quad(lambda x: self.getScatterCoef(x), d1, self.surfaceDistance)
 
-        contrast = math.exp(-scatterCoefIntResult2)/(1 - self.shadeIrradiationRatio + (self.shadeIrradiationRatio/math.exp(-scatterCoefIntResult1)))
-
-        return contrast
+        return math.exp(-scatterCoefIntResult2)/(1 - self.shadeIrradiationRatio + (self.shadeIrradiationRatio/math.exp(-scatterCoefIntResult1)))
 
     def hasContrast(self):
-        return self.getContrast() > 0.02 # 0.02 is from Below the Horizon, Michael Vollmer, 2020
+        return self.getContrast() > minContrast
 
     def isValid(self):
         return not self.isObstructed() and self.hasContrast()
                                                             
     def plot(self, baseline='sea', legendLocation='best', plotPath=''):
 
-        distances = np.array([point.surfaceDistance/1000.0 for point in self.losPoints])
-        ground = np.array([point.elevation for point in self.losPoints])
-        light = np.array([self.getLightElevation(point.surfaceDistance) for point in self.losPoints])
-        straight = np.array([self.getStraightElelvation(point.surfaceDistance) for point in self.losPoints])
+        distances = self.surfaceDistances/1000.0
+        ground = self.elevations
+        light = self.getLightElevation(self.surfaceDistances)
+        straight = self.getStraightElelvation(self.surfaceDistances)
 
         if baseline == 'light':
             ground, light, straight = ground-light, light-light, straight-light
@@ -433,6 +884,190 @@ class LineOfSight():
 
         plt.show()
 
+# Many lines of sight evaluated together, each array entry is one observer/target pair (LineOfSight is a batch of one)
+# Samples of all pairs are packed one pair after the other into flat arrays, pairIds says which pair a sample belongs to
+class LineOfSightBatch():
+
+    def __init__(self,
+                 observers,
+                 targets,
+                 lightCurvature = defaultLightCurvature,
+                 scatterCoef0 = defaultScatterCoef0,
+                 minSamplingDistance = defaultMaxSamplingDistance,
+                 shadedRatio = defaultShadedRatio, 
+                 shadeIrradiationRatio = defaultShadeIrradiationRatio):
+
+        # observers and targets are Points (or DataFrames) of arrays or scalars, scalars are shared by every pair
+        endPoints = np.broadcast_arrays(*[np.atleast_1d(np.asarray(values, dtype=float)) for values in
+                                          (observers.latitude, observers.longitude, observers.elevation,
+                                           targets.latitude, targets.longitude, targets.elevation)])
+        (self.observerLatitudes, self.observerLongitudes, self.observerElevations,
+         self.targetLatitudes, self.targetLongitudes, self.targetElevations) = endPoints
+
+        self.lightCurvature = lightCurvature
+        self.scatterCoef0 = scatterCoef0
+        self.shadedRatio = shadedRatio
+        self.shadeIrradiationRatio = shadeIrradiationRatio
+
+        _, _, self.surfaceDistances = geod.inv(self.observerLongitudes, self.observerLatitudes, self.targetLongitudes, self.targetLatitudes)
+        self.numSamples = np.ceil(self.surfaceDistances/minSamplingDistance).astype(int)
+
+        # Every pair is rotated so its target lies on the x axis, the rotation only depends on the end points
+        targetAngles = self.surfaceDistances/earthRadius
+        targetXDistances = earthRadius * np.sin(targetAngles)
+        targetYHeights = self.targetElevations - earthRadius * (1 - np.cos(targetAngles)) - self.observerElevations
+        rotationAngles = -np.arctan(targetYHeights/targetXDistances)
+        self.rotationCosines = np.cos(rotationAngles)
+        self.rotationSines = np.sin(rotationAngles)
+        self.straightDistances = self.rotationCosines*targetXDistances - self.rotationSines*targetYHeights
+        self.gammas = (self.lightCurvature*earthRadius)**2 - self.straightDistances**2
+
+        # Samples i*D/(n+1) for i = 1..n along every great circle, like geod.npts
+        self.sampleStarts = np.cumsum(self.numSamples) - self.numSamples
+        self.pairIds = np.repeat(np.arange(len(self)), self.numSamples)
+        self.sampleNumbers = np.arange(len(self.pairIds)) - self.sampleStarts[self.pairIds]
+        self.sampleFractions = (self.sampleNumbers + 1)/(self.numSamples[self.pairIds] + 1)
+        self.sampleSurfaceDistances = self.surfaceDistances[self.pairIds] * self.sampleFractions
+
+        self.sampleLatitudes = np.full(len(self.pairIds), np.nan) # nan until fetched
+        self.sampleLongitudes = np.full(len(self.pairIds), np.nan)
+        self.sampleElevations = np.full(len(self.pairIds), np.nan)
+        self.excessHeights = np.full(len(self.pairIds), np.nan) # Ground above the light, nan until fetched or when not checked
+
+        self.contrasts = None
+
+    def __len__(self):
+        return len(self.surfaceDistances)
+
+    def process(self, strides=[1], probeDistances=None):
+
+        # Pairs without contrast are out of view whatever the terrain, so their samples are never fetched
+        isOpen = self.hasContrast()
+
+        # Where a pair has a probe distance (nan for none) its sample closest to it is fetched before any stride,
+        # an obstruction there is as real as one found by the strides
+        if probeDistances is not None:
+            probePairIds = np.flatnonzero(isOpen & ~np.isnan(probeDistances) & (self.numSamples > 0))
+            probeSampleNumbers = np.round(probeDistances[probePairIds]/self.surfaceDistances[probePairIds]*(self.numSamples[probePairIds] + 1)) - 1
+            probeSampleNumbers = np.clip(probeSampleNumbers, 0, self.numSamples[probePairIds] - 1).astype(int)
+            self.fetchSamples(self.sampleStarts[probePairIds] + probeSampleNumbers)
+            isOpen &= ~self.isObstructed()
+
+        # One elevation request per stride for every pair still open
+        for stride in strides:
+            fetchMask = isOpen[self.pairIds] & np.isnan(self.sampleElevations) & (self.sampleNumbers % stride == 0)
+            self.fetchSamples(np.flatnonzero(fetchMask))
+            isOpen &= ~self.isObstructed()
+
+    def fetchSamples(self, sampleIds):
+        if len(sampleIds) > 0:
+            self.sampleLatitudes[sampleIds], self.sampleLongitudes[sampleIds] = self.getSampleCoordinates(sampleIds)
+            self.sampleElevations[sampleIds] = getElevations(self.sampleLatitudes[sampleIds], self.sampleLongitudes[sampleIds])
+            self.excessHeights[sampleIds] = self.getExcessHeights(sampleIds)
+
+    def getSampleCoordinates(self, sampleIds):
+        # Only worked out for the samples that are fetched, most samples of an obstructed pair never are
+        return getGreatCirclePoints(self.observerLatitudes, self.observerLongitudes, self.targetLatitudes, self.targetLongitudes,
+                                    self.pairIds[sampleIds], self.sampleFractions[sampleIds])
+
+    def getRotatedProfiles(self, pairIds, surfaceDistances, elevations):
+
+        # Straight distance along the rotated chord, ground height above it and light height above it of points of the given pairs
+        angles = surfaceDistances/earthRadius
+        xDistances = earthRadius * np.sin(angles)
+        yHeights = elevations - earthRadius * (1 - np.cos(angles)) - self.observerElevations[pairIds]
+
+        rotationCosines = self.rotationCosines[pairIds]
+        rotationSines = self.rotationSines[pairIds]
+        straightDistances = rotationCosines*xDistances - rotationSines*yHeights
+        groundHeights = rotationSines*xDistances + rotationCosines*yHeights
+
+        distancesToTarget = self.straightDistances[pairIds]
+        gammas = self.gammas[pairIds]
+        lightHeights = np.sqrt(gammas + straightDistances*(distancesToTarget - straightDistances)) - np.sqrt(gammas)
+
+        return straightDistances, groundHeights, lightHeights
+
+    def getExcessHeights(self, sampleIds):
+
+        # Ground height above the light at the samples if they are in the checked range, nan otherwise
+        p = self.pairIds[sampleIds]
+        straightDistances, groundHeights, lightHeights = self.getRotatedProfiles(p, self.sampleSurfaceDistances[sampleIds], self.sampleElevations[sampleIds])
+
+        isChecked = (straightDistances > ignoreBuffer) & (straightDistances < self.straightDistances[p] - ignoreBuffer)
+        return np.where(isChecked, groundHeights - lightHeights, np.nan)
+
+    def getProfile(self, pairId):
+
+        # End points and fetched samples of one pair in order from the observer, as used by LineOfSight
+        sampleIds = self.sampleStarts[pairId] + np.arange(self.numSamples[pairId])
+        sampleIds = sampleIds[~np.isnan(self.sampleElevations[sampleIds])]
+
+        latitudes = np.concatenate([[self.observerLatitudes[pairId]], self.sampleLatitudes[sampleIds], [self.targetLatitudes[pairId]]])
+        longitudes = np.concatenate([[self.observerLongitudes[pairId]], self.sampleLongitudes[sampleIds], [self.targetLongitudes[pairId]]])
+        elevations = np.concatenate([[self.observerElevations[pairId]], self.sampleElevations[sampleIds], [self.targetElevations[pairId]]])
+        surfaceDistances = np.concatenate([[0], self.sampleSurfaceDistances[sampleIds], [self.surfaceDistances[pairId]]])
+
+        straightDistances, groundHeights, lightHeights = self.getRotatedProfiles(np.full(len(elevations), pairId), surfaceDistances, elevations)
+
+        return latitudes, longitudes, elevations, surfaceDistances, straightDistances, lightHeights, groundHeights
+
+    def isObstructed(self):
+        return np.bincount(self.pairIds[self.excessHeights >= 0], minlength=len(self)) > 0
+
+    def getObstructionPoints(self):
+
+        # Surface distance and elevation of the sample rising furthest above the light of every pair, nan when unobstructed
+        obstructionDistances = np.full(len(self), np.nan)
+        obstructionElevations = np.full(len(self), np.nan)
+
+        excessHeights = self.excessHeights
+        isObstructing = excessHeights >= 0
+        if not isObstructing.any():
+            return obstructionDistances, obstructionElevations
+
+        hasSamples = self.numSamples > 0
+        maxExcessHeights = np.full(len(self), np.nan)
+        maxExcessHeights[hasSamples] = np.fmax.reduceat(excessHeights, self.sampleStarts[hasSamples])
+
+        isHighest = isObstructing & (excessHeights == maxExcessHeights[self.pairIds])
+        obstructedPairIds, firstHighest = np.unique(self.pairIds[isHighest], return_index=True)
+        highestSamples = np.flatnonzero(isHighest)[firstHighest]
+
+        obstructionDistances[obstructedPairIds] = self.sampleSurfaceDistances[highestSamples]
+        obstructionElevations[obstructedPairIds] = self.sampleElevations[highestSamples]
+
+        return obstructionDistances, obstructionElevations
+
+    def getScatterCoefIntegrals(self, x1, x2):
+        nodes, weights = getQuadratureNodes(contrastQuadratureOrder)
+        Mx, My, RL = getLightCircles(self.observerElevations, self.targetElevations, self.surfaceDistances, self.lightCurvature)
+
+        halfWidths = (x2 - x1)/2
+        x = x1[:, np.newaxis] + halfWidths[:, np.newaxis]*(nodes + 1)
+        scatterCoefs = self.scatterCoef0 * np.exp(-getLightElevations((Mx[:, np.newaxis], My[:, np.newaxis], RL), x)/atmosphereScaleHeight)
+
+        return halfWidths * (scatterCoefs @ weights)
+
+    def getContrasts(self):
+
+        if self.contrasts is None:
+
+            d1 = self.surfaceDistances * self.shadedRatio
+
+            scatterCoefIntResults1 = self.getScatterCoefIntegrals(np.zeros(len(self)), d1)
+            scatterCoefIntResults2 = self.getScatterCoefIntegrals(d1, self.surfaceDistances)
+
+            self.contrasts = np.exp(-scatterCoefIntResults2)/(1 - self.shadeIrradiationRatio + (self.shadeIrradiationRatio/np.exp(-scatterCoefIntResults1)))
+
+        return self.contrasts
+
+    def hasContrast(self):
+        return self.getContrasts() > minContrast
+
+    def isValid(self):
+        return self.hasContrast() & ~self.isObstructed()
+
 class Patch():
 
     def __init__(self,
@@ -440,9 +1075,15 @@ class Patch():
                  southInner,
                  eastInner=None,
                  westInner=None,
-                 globalSummits=None):
+                 globalSummits=None,
+                 globalMaxElevation=None):
+
+        # getSummitsInRange finds latitude bands by binary search, so globalSummits must be sorted by latitude (see patch_maker.py)
+        if globalSummits is not None:
+            assert(globalSummits.latitude.is_monotonic_increasing)
 
         self.globalSummits = globalSummits
+        self.globalMaxElevation = globalMaxElevation
         
         self.numSummitsInner = None
         self.summitsOuter = None
@@ -460,6 +1101,10 @@ class Patch():
         self.latOffset = None
         self.lngOffset = None
 
+        self.offsetDistance = None
+        self.bufferMaxElevation = None
+        self.bufferIterations = None
+
         if type(globalSummits) == type(None):
             try:
                 self.loadPatch()
@@ -475,49 +1120,115 @@ class Patch():
     def __str__(self):        
         return self.getMetadata()
 
-    def getFileName(self):
+    def getMemoryUsage(self):
+        if self.summitsOuter is None:
+            return 0
+        return int(self.summitsOuter.memory_usage(index=True).sum())
+
+    def getName(self):
         if self.isPolePatch():
-            fileName = f'{self.northInner}N_{self.southInner}S.csv'
+            name = f'{self.northInner}N_{self.southInner}S'
         else:
-            fileName = f'{self.northInner}N_{self.southInner}S_{self.eastInner}E_{self.westInner}W.csv'
-        return fileName
+            name = f'{self.northInner}N_{self.southInner}S_{self.eastInner}E_{self.westInner}W'
+        return name
+
+    def getFileName(self):
+        if patchFormat == 'npy':
+            return self.getName()
+        return f'{self.getName()}.csv'
 
     def loadPatch(self):
-        fileName = self.getFileName()
+        # Patches saved before the npy format are still read from their csv
+        if os.path.isdir(f'{patchDirectory}/{self.getName()}'):
+            self.loadNpyPatch()
+        else:
+            self.loadCsvPatch()
+
+    def loadNpyPatch(self):
+        patchPath = f'{patchDirectory}/{self.getName()}'
 
-        # reading metadata
-        metaDataList = []
+        with open(f'{patchPath}/metadata.json', 'r') as metadataFile:
+            metadata = json.load(metadataFile)
+        self.setMetadata(metadata)
+
+        # Columns stay memory-mapped and read-only, pages are only read as they are used
+        self.summitsOuter = pd.DataFrame({column: np.load(f'{patchPath}/{column}.npy', mmap_mode='r') 
+                                          for column in metadata['columns']}, copy=False)
+
+    def loadCsvPatch(self):
+        fileName = f'{self.getName()}.csv'
+
+        # reading metadata by label from the comment lines
+        metadata = {}
         with open(f'{patchDirectory}/{fileName}', 'r') as rawMetaData:
-            for i, line in enumerate(rawMetaData):
-                if i >= 17:
+            for line in rawMetaData:
+                if not line.startswith('#'):
                     break
-                metaDataList.append(line.strip().split(': '))
-                
-        self.numGlobalSummits = int(metaDataList[0][1])
-        self.numSummitsInner = int(metaDataList[2][1])
+                label, _, value = line[1:].strip().partition(': ')
+                if label in patchMetadataLabels:
+                    metadata[patchMetadataLabels[label]] = None if value == 'None' else float(value)
+        self.setMetadata(metadata)
+
+        summitsOuter = readSummits(f'{patchDirectory}/{fileName}', comment='#')
+
+        # Read-only like the memory-mapped npy columns, so a patch shared through patchCache can not be changed in place
+        columns = {}
+        for column in summitsOuter.columns:
+            columns[column] = summitsOuter[column].to_numpy(copy=True)
+            columns[column].setflags(write=False)
+        self.summitsOuter = pd.DataFrame(columns, copy=False)
+
+    def setMetadata(self, metadata):
+        self.numGlobalSummits = int(metadata['numGlobalSummits'])
+        self.numSummitsInner = int(metadata['numSummitsInner'])
+
+        self.northOuter = metadata['northOuter']
+        self.southOuter = metadata['southOuter']
+        self.eastOuter = metadata['eastOuter']
+        self.westOuter = metadata['westOuter']
+
+        self.latOffset = metadata['latOffset']
+        self.lngOffset = metadata['lngOffset']
+
+        # Not recorded in patches made before the adaptive buffer
+        self.offsetDistance = metadata.get('offsetDistance')
+        self.bufferMaxElevation = metadata.get('bufferMaxElevation')
+        if metadata.get('bufferIterations') is not None:
+            self.bufferIterations = int(metadata['bufferIterations'])
+
+    def getMetadataDict(self):
+        metadata = {key: getattr(self, key) for key in patchMetadataLabels.values()}
+        metadata['numSummitsOuter'] = len(self.summitsOuter)
+        metadata['columns'] = list(self.summitsOuter.columns)
+
+        # NumPy scalars from the patch boundaries are not JSON serializable
+        return {key: value.item() if isinstance(value, np.generic) else value for key, value in metadata.items()}
 
-        self.northOuter = float(metaDataList[10][1])
-        self.southOuter = float(metaDataList[11][1])
+    def save(self):
+        if patchFormat == 'npy':
+            self.saveNpy()
+        else:
+            self.saveCsv()
 
-        eastOuter = metaDataList[12][1]
-        self.eastOuter = float(eastOuter) if eastOuter != 'None' else None
-        westOuter = metaDataList[13][1]        
-        self.westOuter = float(westOuter) if westOuter != 'None' else None
+    def saveNpy(self):
+        patchPath = f'{patchDirectory}/{self.getName()}'
+        os.makedirs(patchPath, exist_ok=True)
 
+        for column in self.summitsOuter.columns:
+            np.save(f'{patchPath}/{column}.npy', self.summitsOuter[column].to_numpy())
 
-        self.latOffset = float(metaDataList[15][1])
-        lngOffset = metaDataList[16][1] 
-        self.lngOffset = float(lngOffset) if lngOffset != 'None' else None
+        with open(f'{patchPath}/metadata.json', 'w') as metadataFile:
+            json.dump(self.getMetadataDict(), metadataFile, indent=4)
 
-        self.summitsOuter = pd.read_csv(f'{patchDirectory}/{fileName}', comment='#')
+        print(f'Saved {self.getName()}')
 
-    def save(self):
-        fileName = self.getFileName()
+    def saveCsv(self):
+        fileName = f'{self.getName()}.csv'
         
         # this is needed to add the metadata as a comment in csv before data
         with open(f'{patchDirectory}/{fileName}', 'w') as patchFile:
             patchFile.write(self.getMetadata(isComment=True))
-            self.summitsOuter.to_csv(patchFile, index=False)
+            writeSummits(self.summitsOuter, patchFile, index=False)
             print(f'Saved {fileName}')
 
     def getMetadata(self, isComment=False):
@@ -539,7 +1250,11 @@ class Patch():
             West (Outer): {self.westOuter}
 
             Lat Offset: {self.latOffset}
-            Lng Offset: {self.lngOffset}\
+            Lng Offset: {self.lngOffset}
+
+            Offset Distance: {self.offsetDistance}
+            Buffer Max Elevation: {self.bufferMaxElevation}
+            Buffer Iterations: {self.bufferIterations}\
         """)
         
         if isComment:
@@ -567,15 +1282,19 @@ class Patch():
         return longitude
 
     def convertDistanceToDeltaLat(self, distance):
-        return distance / 111320  # There are 111320 m per deg of latitude
+        # Angle of the distance on the sphere of geod, no point closer than that is further away in latitude
+        return math.degrees(distance/geod.a)
 
     def convertDistanceToDeltaLng(self, distance, latitude):
-        return self.convertDistanceToDeltaLat(distance) / math.cos(math.radians(latitude))
+        # Widest longitude span of a spherical cap centred at latitude, like SummitIndex.getCellsInRange
+        # None if the cap reaches a pole, then every longitude is in range
+        sinRatio = math.sin(min(distance/geod.a, math.pi/2))/math.cos(math.radians(latitude))
+        if sinRatio >= 1:
+            return None
+        return math.degrees(math.asin(sinRatio))
 
-    def getOffsetDistance(self):
-        summitsInner = self.getSummitsInRange(self.northInner, self.southInner, self.eastInner, self.westInner)
-        self.numSummitsInner = len(summitsInner)
-        return horizonDistance(self.globalSummits.elevation.max()) + horizonDistance(summitsInner.elevation.max())
+    def getOffsetDistance(self, innerMaxElevation):
+        return horizonDistance(self.bufferMaxElevation) + horizonDistance(innerMaxElevation) + patchBufferMargin
 
     def getPatchSummits(latitude, longitude):
         poleLatitude = getPoleLatitude()
@@ -594,28 +1313,276 @@ class Patch():
         return Patch(latMin+patchSize, latMin, lngMin+patchSize, lngMin)
 
     def setOuterBounds(self):
-        offsetDistance = self.getOffsetDistance()
-        
+        summitsInner = self.getSummitsInRange(self.northInner, self.southInner, self.eastInner, self.westInner)
+        self.numSummitsInner = len(summitsInner)
+        innerMaxElevation = summitsInner.elevation.max()
+
+        if self.globalMaxElevation is None:
+            self.globalMaxElevation = self.globalSummits.elevation.max()
+
+        self.bufferMaxElevation = self.globalMaxElevation
+        self.bufferIterations = 0
+        self.setOuterBoundsFromOffset(self.getOffsetDistance(innerMaxElevation))
+
+        if patchBufferMode == 'adaptive':
+            # A disqualifier of an inner summit is closer than the offset, so it is inside the current outer bounds
+            # and no higher than the highest summit there. Padding for that summit is enough, and since the new
+            # bounds sit inside the old ones this holds again at every step until the highest summit stops changing
+            while True:
+                summitsOuter = self.getSummitsInRange(self.northOuter, self.southOuter, self.eastOuter, self.westOuter)
+                outerMaxElevation = summitsOuter.elevation.max()
+                if not outerMaxElevation < self.bufferMaxElevation:
+                    break
+                self.bufferMaxElevation = outerMaxElevation
+                self.bufferIterations += 1
+                self.setOuterBoundsFromOffset(self.getOffsetDistance(innerMaxElevation))
+
+    def setOuterBoundsFromOffset(self, offsetDistance):
+        self.offsetDistance = offsetDistance
+
         self.latOffset = self.convertDistanceToDeltaLat(offsetDistance)
         self.northOuter = self.makeLatitudeValid(self.northInner + self.latOffset)
         self.southOuter = self.makeLatitudeValid(self.southInner - self.latOffset)
 
         if not self.isPolePatch():
-            latForOffset = self.southInner if self.southInner < 0 else self.northInner
+            # Caps around the inner summits are widest in longitude at the inner edge closest to a pole
+            latForOffset = max(abs(self.northInner), abs(self.southInner))
             self.lngOffset = self.convertDistanceToDeltaLng(offsetDistance, latForOffset)
 
-            self.eastOuter = self.makeLongitudeValid(self.eastInner + self.lngOffset)
-            self.westOuter = self.makeLongitudeValid(self.westInner - self.lngOffset)
+            if self.lngOffset is None or 2*self.lngOffset + (self.eastInner - self.westInner) >= 360:
+                self.lngOffset = 180
+                self.eastOuter = 180
+                self.westOuter = -180
+            else:
+                self.eastOuter = self.makeLongitudeValid(self.eastInner + self.lngOffset)
+                self.westOuter = self.makeLongitudeValid(self.westInner - self.lngOffset)
 
     def getSummitsInRange(self, northBound, southBound, eastBound, westBound):
         
-        latCondition = 'latitude >= @southBound and latitude < @northBound'
+        # The latitude band is a slice of the latitude-sorted summits, found by binary search instead of a full scan
+        latitudes = self.globalSummits.latitude.to_numpy()
+        bandStart = np.searchsorted(latitudes, southBound, side='left')
+        bandEnd = np.searchsorted(latitudes, northBound, side='left')
+        summitsInBand = self.globalSummits.iloc[bandStart:bandEnd]
         
         if self.isPolePatch():
-            summitsInRange = self.globalSummits.query(latCondition)
-        elif self.isLngSeamPatch(eastBound, westBound):
-            summitsInRange = self.globalSummits.query(latCondition + ' and (longitude >= @westBound or longitude < @eastBound)')
+            summitsInRange = summitsInBand
         else:
-            summitsInRange = self.globalSummits.query(latCondition + ' and longitude >= @westBound and longitude < @eastBound')
+            longitudes = summitsInBand.longitude.to_numpy()
+            if self.isLngSeamPatch(eastBound, westBound):
+                summitsInRange = summitsInBand[(longitudes >= westBound) | (longitudes < eastBound)]
+            else:
+                summitsInRange = summitsInBand[(longitudes >= westBound) & (longitudes < eastBound)]
         
-        return summitsInRange
\ No newline at end of file
+        return summitsInRange.sort_index() # Back to the order of the summit file
+
+# Global cell grid over summits that answers "summits higher than h within radius r of (lat, lng)"
+# Summits are stored sorted by cell, so each cell is the slice [cellStarts[i], cellStarts[i+1])
+class SummitIndex():
+
+    def __init__(self,
+                 summits=None,
+                 cellSize=summitIndexCellSize):
+
+        self.cellSize = cellSize
+        self.numLatCells = math.ceil(180/cellSize)
+        self.numLngCells = math.ceil(360/cellSize)
+
+        self.columns = None
+        self.cellStarts = None
+        self.cellMaxElevations = None
+        self.maxHorizonDistance = None
+
+        if type(summits) == type(None):
+            self.load()
+        else:
+            self.build(summits)
+
+    def __len__(self):
+        return len(self.columns['summitId'])
+
+    def getCellIds(self, latitudes, longitudes):
+        latIndices = np.clip(np.floor((np.asarray(latitudes) + 90)/self.cellSize).astype(int), 0, self.numLatCells-1)
+        lngIndices = np.floor((np.asarray(longitudes) + 180)/self.cellSize).astype(int) % self.numLngCells
+        return latIndices*self.numLngCells + lngIndices
+
+    def build(self, summits):
+        cellIds = self.getCellIds(summits.latitude.to_numpy(), summits.longitude.to_numpy())
+        order = np.argsort(cellIds, kind='stable')
+        cellIds = cellIds[order]
+
+        self.columns = {column: summits[column].to_numpy()[order] for column in summits.columns}
+
+        numCells = self.numLatCells*self.numLngCells
+        self.cellStarts = np.concatenate([[0], np.cumsum(np.bincount(cellIds, minlength=numCells))])
+
+        self.cellMaxElevations = np.full(numCells, -np.inf)
+        np.maximum.at(self.cellMaxElevations, cellIds, self.columns['elevation'])
+
+        self.maxHorizonDistance = float(self.columns['maxHorizonDistance'].max())
+
+    def save(self):
+        np.savez(summitIndexFile,
+                 cellSize=self.cellSize,
+                 cellStarts=self.cellStarts,
+                 cellMaxElevations=self.cellMaxElevations,
+                 columnNames=np.array(list(self.columns)),
+                 **{f'column_{name}': values for name, values in self.columns.items()})
+        print(f'Saved {summitIndexFile} ({len(self)} summits)')
+
+    def load(self):
+        with np.load(summitIndexFile) as data:
+            assert(float(data['cellSize']) == self.cellSize)
+            self.cellStarts = data['cellStarts']
+            self.cellMaxElevations = data['cellMaxElevations']
+            self.columns = {name: data[f'column_{name}'] for name in data['columnNames']}
+        self.maxHorizonDistance = float(self.columns['maxHorizonDistance'].max())
+
+    def getCellsInRange(self, latitude, longitude, radius):
+        angularRadius = radius/geod.a
+        deltaLat = math.degrees(angularRadius)
+
+        southIndex = max(math.floor((latitude - deltaLat + 90)/self.cellSize), 0)
+        northIndex = min(math.floor((latitude + deltaLat + 90)/self.cellSize), self.numLatCells-1)
+        latIndices = np.arange(southIndex, northIndex+1)
+
+        # Widest longitude span of a spherical cap, unbounded if the cap reaches a pole
+        sinRatio = math.sin(min(angularRadius, math.pi/2))/math.cos(math.radians(latitude))
+        if sinRatio >= 1:
+            lngIndices = np.arange(self.numLngCells)
+        else:
+            deltaLng = math.degrees(math.asin(sinRatio))
+            westIndex = math.floor((longitude - deltaLng + 180)/self.cellSize)
+            eastIndex = math.floor((longitude + deltaLng + 180)/self.cellSize)
+            if eastIndex - westIndex + 1 >= self.numLngCells:
+                lngIndices = np.arange(self.numLngCells)
+            else:
+                lngIndices = np.arange(westIndex, eastIndex+1) % self.numLngCells
+
+        return (latIndices[:, None]*self.numLngCells + lngIndices[None, :]).ravel()
+
+    def query(self, latitude, longitude, radius, minElevation=-np.inf):
+        cellIds = self.getCellsInRange(latitude, longitude, radius)
+        cellIds = cellIds[self.cellMaxElevations[cellIds] > minElevation]
+
+        starts = self.cellStarts[cellIds]
+        ends = self.cellStarts[cellIds+1]
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.array([], dtype=int)])
+
+        rows = rows[self.columns['elevation'][rows] > minElevation]
+        distances = getDistances(latitude, longitude, self.columns['latitude'][rows], self.columns['longitude'][rows])
+
+        isInRange = distances < radius
+        rows = rows[isInRange]
+        distances = distances[isInRange]
+
+        # Same row order as the summit file so ties sort the same way as with patches
+        order = np.argsort(self.columns['summitId'][rows], kind='stable')
+        rows = rows[order]
+
+        summitsInRange = pd.DataFrame({name: values[rows] for name, values in self.columns.items()})
+        return summitsInRange, distances[order]
+
+class ElevationCache():
+
+    def __init__(self):
+
+        self.numLngNodes = round(360/elevationCacheResolution)
+
+        os.makedirs(os.path.dirname(elevationCacheFile), exist_ok=True)
+        self.connection = sqlite3.connect(elevationCacheFile, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS elevations (node INTEGER PRIMARY KEY, elevation REAL)')
+
+        self.memory = OrderedDict()
+
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    def __str__(self):
+        numLookups = max(self.memoryHits + self.diskHits + self.misses, 1)
+        return (f'Elevation cache: {self.memoryHits} memory hits, {self.diskHits} disk hits, {self.misses} misses '
+                f'({round(100*(self.memoryHits + self.diskHits)/numLookups, 2)}% hit rate)')
+
+    def getNodes(self, latitudes, longitudes):
+        latIndices = np.round((np.asarray(latitudes, dtype=float) + 90)/elevationCacheResolution).astype(np.int64)
+        lngIndices = np.round((np.asarray(longitudes, dtype=float) + 180)/elevationCacheResolution).astype(np.int64) % self.numLngNodes
+        return latIndices*self.numLngNodes + lngIndices
+
+    def getNodeCoordinates(self, nodes):
+        latitudes = (nodes // self.numLngNodes)*elevationCacheResolution - 90
+        longitudes = (nodes % self.numLngNodes)*elevationCacheResolution - 180
+        return latitudes, longitudes
+
+    def getCounts(self):
+        return np.array([self.memoryHits, self.diskHits, self.misses])
+
+    def addCounts(self, counts):
+        # Lookups made by worker processes, which each have their own cache
+        memoryHits, diskHits, misses = counts
+        self.memoryHits += int(memoryHits)
+        self.diskHits += int(diskHits)
+        self.misses += int(misses)
+
+    def getMemoryUsage(self):
+        return len(self.memory)*elevationCacheEntrySize
+
+    def remember(self, node, elevation):
+        self.memory[node] = elevation
+        self.memory.move_to_end(node)
+        while self.getMemoryUsage() > elevationCacheMemorySize:
+            self.memory.popitem(last=False)
+
+    def getElevations(self, latitudes, longitudes):
+
+        nodes, inverse = np.unique(self.getNodes(latitudes, longitudes), return_inverse=True)
+        nodeElevations = np.full(len(nodes), np.nan)
+
+        # Voids are cached as nan too, so what is missing is tracked separately
+        isMissing = np.ones(len(nodes), dtype=bool)
+
+        # In-memory LRU first
+        for i, node in enumerate(nodes.tolist()):
+            if node in self.memory:
+                self.memory.move_to_end(node)
+                nodeElevations[i] = self.memory[node]
+                isMissing[i] = False
+
+        self.memoryHits += int((~isMissing).sum())
+
+        # Then the SQLite file, in chunks below SQLite's bound variable limit
+        if isMissing.any():
+            missingNodes = nodes[isMissing].tolist()
+            storedElevations = {}
+            for i in range(0, len(missingNodes), 900):
+                chunk = missingNodes[i : i+900]
+                storedElevations.update(self.connection.execute(f'SELECT node, elevation FROM elevations WHERE node IN ({",".join("?"*len(chunk))})', chunk))
+
+            for i in np.flatnonzero(isMissing):
+                node = int(nodes[i])
+                if node in storedElevations:
+                    # SQLite stores nan as NULL
+                    elevation = np.nan if storedElevations[node] is None else storedElevations[node]
+                    nodeElevations[i] = elevation
+                    isMissing[i] = False
+                    self.remember(node, elevation)
+            
+            self.diskHits += len(storedElevations)
+
+        # Only what is left goes to the elevation source
+        if isMissing.any():
+            missingNodes = nodes[isMissing]
+            nodeLatitudes, nodeLongitudes = self.getNodeCoordinates(missingNodes)
+            fetchedElevations = np.asarray(getUncachedElevations(nodeLatitudes, nodeLongitudes), dtype=float)
+
+            nodeElevations[isMissing] = fetchedElevations
+            self.misses += len(missingNodes)
+
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO elevations VALUES (?, ?)', 
+                                            zip(missingNodes.tolist(), fetchedElevations.tolist()))
+            for node, elevation in zip(missingNodes.tolist(), fetchedElevations.tolist()):
+                self.remember(node, elevation)
+
+        return nodeElevations[inverse]
\ No newline at end of file
@@ -0,0 +1,10 @@
+import commons as me
+import os
+
+summits = me.readSummits(me.summitFile)
+
+summits['maxHorizonDistance'] = me.horizonDistances(summits.elevation).astype('int32')
+
+os.makedirs(os.path.dirname(me.summitIndexFile), exist_ok=True)
+
+me.SummitIndex(summits).save()
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import commons as me
 import time
 
@@ -10,170 +11,178 @@ def getMinObserverElevation():
 def getMinTargetElevation():
     return (me.defaultLightCurvature-1)/(me.defaultLightCurvature) * (distanceThreshold)**2/(8*me.earthRadius)
 
-startTime = time.time()
+def getCandidateTargets(observer):
 
-summitFile = f'../data/clean/summits_prm.csv'
-prominenceThreshold = 500 # in m
-distanceThreshold = 300*1000 # in m
+    # Only targets the observer could see past the distance threshold, checked with MHDs before any LineOfSight is built
+    observerMhd = me.horizonDistance(observer.elevation)
+    nearbyTargets, distances = targetIndex.query(observer.latitude, observer.longitude, observerMhd + targetIndex.maxHorizonDistance)
 
-summits = pd.read_csv(summitFile)
-numGlobalSummits = len(summits)
+    isCandidate = ((nearbyTargets.summitId.to_numpy() < observer.summitId)
+                   & (distances > distanceThreshold)
+                   & (observerMhd + nearbyTargets.maxHorizonDistance.to_numpy() > distances))
 
-minObserverElevation = getMinObserverElevation()
-minTargetElevation = getMinTargetElevation()
+    return nearbyTargets[isCandidate]
 
-summits = summits.query('prominence > @prominenceThreshold')
-observers = summits.query('elevation > @minObserverElevation')
-targets = summits.query('elevation > @minTargetElevation')
+def generateCandidateBatches():
 
-numSummits = len(summits)
-numObervers = len(observers)
-numTarget = len(targets)
-
-print(f'{numSummits}/{numGlobalSummits} ({round(100*numSummits/numGlobalSummits, 2)}%) summits have at least {prominenceThreshold} m of prominence')
-print(f'{numObervers}/{numSummits} ({round(100*numObervers/numSummits, 2)}%) are beyond the minimum observer elevation ({round(minObserverElevation)} m)')
-print(f'{numTarget}/{numSummits} ({round(100*numTarget/numSummits, 2)}%) are beyond the minimum target elevation ({round(minTargetElevation)} m)')
-print('\n')
-
-candidateLinesOfSight = []
-for i, observer in enumerate(observers.itertuples()):
-
-    targetsForObserver = targets.query('summitId < @observer.summitId')
-    for target in targetsForObserver.itertuples():
+    losBatch = []
+    for i, observer in enumerate(observers.itertuples()):
 
         obs = me.Summit(summitId = observer.summitId,
                         latitude = observer.latitude, 
                         longitude = observer.longitude, 
                         elevation = observer.elevation)
-        
-        trg = me.Summit(summitId = target.summitId,
-                        latitude = target.latitude, 
-                        longitude = target.longitude, 
-                        elevation = target.elevation)
 
-        candidateLos = me.LineOfSight(obs, trg)
+        for target in getCandidateTargets(observer).itertuples():
+            
+            trg = me.Summit(summitId = target.summitId,
+                            latitude = target.latitude, 
+                            longitude = target.longitude, 
+                            elevation = target.elevation)
 
-        if candidateLos.isInPossibleRange() and candidateLos.surfaceDistance > distanceThreshold:
-            candidateLinesOfSight.append(candidateLos)
+            losBatch.append(me.LineOfSight(obs, trg))
+            stageCounts['candidate'] += 1
 
-    if i%1000 == 999 or i == numObervers-1:
-        numLosCandidates = len(candidateLinesOfSight)
-        print(f'Found {numLosCandidates} line of sight candidates in {i+1}/{numObervers} observers')
+            if len(losBatch) == losBatchSize:
+                yield losBatch
+                losBatch = []
 
-print('\n')
+        if i%1000 == 999 or i == numObervers-1:
+            printProgress(f'{i+1}/{numObervers} observers')
 
-losPassedMidTest = []
-for start in range(0, len(candidateLinesOfSight), me.apiRequestLimit):
-    
-    losBatch = candidateLinesOfSight[start:start + me.apiRequestLimit]
+    if losBatch:
+        yield losBatch
 
-    observerLats = [los.observer.latitude for los in losBatch]
-    observerLngs = [los.observer.longitude for los in losBatch]
-    
-    targetLats = [los.target.latitude for los in losBatch]
-    targetLngs = [los.target.longitude for los in losBatch]
+def getEndPoints(losBatch):
 
-    midLats = []
-    midLngs = []
-    midLightElevations = []
+    observers = me.Point(latitude = np.array([los.observer.latitude for los in losBatch]),
+                         longitude = np.array([los.observer.longitude for los in losBatch]),
+                         elevation = np.array([los.observer.elevation for los in losBatch], dtype=float))
     
-    for los in losBatch:
-        
-        observerLat = los.observer.latitude
-        observerLng = los.observer.longitude
-        
-        targetLat = los.target.latitude
-        targetLng = los.target.longitude
+    targets = me.Point(latitude = np.array([los.target.latitude for los in losBatch]),
+                       longitude = np.array([los.target.longitude for los in losBatch]),
+                       elevation = np.array([los.target.elevation for los in losBatch], dtype=float))
 
-        midPoint = me.geod.npts(observerLng, observerLat, targetLng, targetLat, 1)[0]
+    return observers, targets
 
-        midLats.append(midPoint[1])
-        midLngs.append(midPoint[0])
+def filterByMidPoint(losBatches):
 
-        midLightElevations.append(los.getLightElevation(los.surfaceDistance/2))
+    for losBatch in losBatches:
 
-    midElevations = me.getElevations(midLats, midLngs)
+        observers, targets = getEndPoints(losBatch)
+        surfaceDistances = np.array([los.surfaceDistance for los in losBatch])
 
-    for i, los in enumerate(losBatch):
+        # Half way along every great circle at once
+        azimuths, _, _ = me.geod.inv(observers.longitude, observers.latitude, targets.longitude, targets.latitude)
+        midLngs, midLats, _ = me.geod.fwd(observers.longitude, observers.latitude, azimuths, surfaceDistances/2)
 
-        midLightElevation = midLightElevations[i]
-        midElevation = midElevations[i]
-        
-        if midLightElevation > midElevation:
-            losPassedMidTest.append(los)
+        midElevations = np.asarray(me.getElevations(midLats, midLngs), dtype=float)
 
-numLosPassedMidTest = len(losPassedMidTest)
-print(f'{numLosPassedMidTest}/{numLosCandidates} ({round(100*numLosPassedMidTest/numLosCandidates, 2)}%) ' + 
-      'line of sight candidates passed the mid-point test')
-print('\n')
+        lightCircles = me.getLightCircles(observers.elevation, targets.elevation, surfaceDistances)
+        isPassed = me.getLightElevations(lightCircles, surfaceDistances/2) > midElevations
 
-validLinesOfSight = []
-for i, los in enumerate(losPassedMidTest):
-    
-    los.processFullLineOfSight()
+        passedBatch = [los for los, losIsPassed in zip(losBatch, isPassed) if losIsPassed]
+        stageCounts['midpoint'] += len(passedBatch)
 
-    losIsValid = los.isValid()
-    los.losPoints = []
-    
-    if losIsValid:
-        validLinesOfSight.append(los)
+        if passedBatch:
+            yield passedBatch
+
+def filterByFullProfile(losBatches):
+
+    for losBatch in losBatches:
+
+        # Every line of sight of the batch is sampled and checked together
+        linesOfSight = me.LineOfSightBatch(*getEndPoints(losBatch))
+        linesOfSight.process(me.progressiveStrides)
+
+        validBatch = [los for los, losIsValid in zip(losBatch, linesOfSight.isValid()) if losIsValid]
+
+        stageCounts['valid'] += len(validBatch)
+
+        if validBatch:
+            yield validBatch
+
+def getLosData(losBatch):
+    return pd.DataFrame({
+        'observer_summitId': [los.observer.summitId for los in losBatch],
+        'observer_latitude': [los.observer.latitude for los in losBatch],
+        'observer_longitude': [los.observer.longitude for los in losBatch],
+        'observer_elevation': np.array([los.observer.elevation for los in losBatch], dtype=me.summitDtypes['elevation']),
+        'target_summitId': [los.target.summitId for los in losBatch],
+        'target_latitude': [los.target.latitude for los in losBatch],
+        'target_longitude': [los.target.longitude for los in losBatch],
+        'target_elevation': np.array([los.target.elevation for los in losBatch], dtype=me.summitDtypes['elevation']),
+        'distance': [los.surfaceDistance for los in losBatch],
+        'contrast': [los.getContrast() for los in losBatch]
+    })
 
-    if i%1000 == 999 or i == numLosPassedMidTest-1:
-        print(f'Found {len(validLinesOfSight)} valid lines of sight in {i+1}/{numLosPassedMidTest} candidates')
+def printProgress(position):
+    elapsedTime = max(time.time() - pipelineStartTime, 1e-9)
+    print(f'{position}: ' + 
+          ', '.join(f'{count} {stage} ({round(count/elapsedTime, 1)}/s)' for stage, count in stageCounts.items()))
 
+startTime = time.time()
+
+summitFile = f'../data/clean/summits_prm.csv'
+prominenceThreshold = 500 # in m
+distanceThreshold = 300*1000 # in m
+losBatchSize = 100 # Lines of sight per batch in every stage of the pipeline
+
+summits = me.readSummits(summitFile)
+numGlobalSummits = len(summits)
+
+minObserverElevation = getMinObserverElevation()
+minTargetElevation = getMinTargetElevation()
+
+summits = summits.query('prominence > @prominenceThreshold')
+observers = summits.query('elevation > @minObserverElevation')
+targets = summits.query('elevation > @minTargetElevation')
+
+numSummits = len(summits)
+numObervers = len(observers)
+numTarget = len(targets)
+
+print(f'{numSummits}/{numGlobalSummits} ({round(100*numSummits/numGlobalSummits, 2)}%) summits have at least {prominenceThreshold} m of prominence')
+print(f'{numObervers}/{numSummits} ({round(100*numObervers/numSummits, 2)}%) are beyond the minimum observer elevation ({round(minObserverElevation)} m)')
+print(f'{numTarget}/{numSummits} ({round(100*numTarget/numSummits, 2)}%) are beyond the minimum target elevation ({round(minTargetElevation)} m)')
 print('\n')
 
-observerSummitIds = []
-observerLatitudes = []
-observerLongitudes = []
-observerElevations = []
+targetIndex = me.SummitIndex(targets.assign(maxHorizonDistance=me.horizonDistances(targets.elevation)))
 
-targetSummitIds = []
-targetLatitudes = []
-targetLongitudes = []
-targetElevations = []
+# Each stage pulls bounded batches from the one before it, so memory does not grow with the number of pairs
+stageCounts = {'candidate': 0, 'midpoint': 0, 'valid': 0}
+pipelineStartTime = time.time()
 
-surfaceDistances = []
-contrasts = []
+losFile = '../data/results/longest_los/longest_los.csv'
+maxLosFile = '../data/results/longest_los/longest_los_max.csv'
 
-for los in validLinesOfSight:
-    
-    observerSummitIds.append(los.observer.summitId)
-    observerLatitudes.append(los.observer.latitude)
-    observerLongitudes.append(los.observer.longitude)
-    observerElevations.append(los.observer.elevation)
-    
-    targetSummitIds.append(los.target.summitId)
-    targetLatitudes.append(los.target.latitude)
-    targetLongitudes.append(los.target.longitude)
-    targetElevations.append(los.target.elevation)
-    
-    surfaceDistances.append(los.surfaceDistance)
-    contrasts.append(los.getContrast())
-
-losData = pd.DataFrame({
-    'observer_summitId': observerSummitIds,
-    'observer_latitude': observerLatitudes,
-    'observer_longitude': observerLongitudes,
-    'observer_elevation': observerElevations,
-    'target_summitId': targetSummitIds,
-    'target_latitude': targetLatitudes,
-    'target_longitude': targetLongitudes,
-    'target_elevation': targetElevations,
-    'distance': surfaceDistances,
-    'contrast': contrasts
-})
-
-maxLosData = losData.loc[losData.groupby('observer_summitId')['distance'].idxmax()]
-
-losData['distance'] = losData.distance.astype(int)
-losData['contrast'] = losData.contrast.round(4)
+maxLosData = None
+isFirstBatch = True
+for validBatch in filterByFullProfile(filterByMidPoint(generateCandidateBatches())):
+
+    losData = getLosData(validBatch)
+
+    # Longest line of sight per observer so far, earlier rows win ties like idxmax
+    maxLosData = pd.concat([maxLosData, losData], ignore_index=True)
+    maxLosData = maxLosData.loc[maxLosData.groupby('observer_summitId')['distance'].idxmax()].reset_index(drop=True)
+
+    losData['distance'] = losData.distance.astype(int)
+    losData['contrast'] = losData.contrast.round(4)
+
+    losData.to_csv(losFile, index=False, mode='w' if isFirstBatch else 'a', header=isFirstBatch)
+    isFirstBatch = False
+
+print('\n')
+printProgress('Done')
+
+if maxLosData is None:
+    maxLosData = getLosData([])
+    maxLosData.to_csv(losFile, index=False)
 
 maxLosData['distance'] = maxLosData.distance.astype(int)
 maxLosData['contrast'] = maxLosData.contrast.round(4)
 
-losData.to_csv('../data/results/longest_los/longest_los.csv', index=False)
-maxLosData.to_csv('../data/results/longest_los/longest_los_max.csv', index=False)
+maxLosData.to_csv(maxLosFile, index=False)
 
 endTime = time.time()
 totalTime = round(endTime - startTime)
@@ -1,29 +1,41 @@
-import pandas as pd
 import commons as me
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+numWorkers = 8 # Patches are written in parallel by this many processes
+
+def makePatch(patchBounds):
+    northInner, southInner, eastInner, westInner = patchBounds
+    me.Patch(globalSummits = summits,
+             globalMaxElevation = globalMaxElevation,
+             northInner = northInner,
+             southInner = southInner,
+             eastInner = eastInner,
+             westInner = westInner)
 
 poleLat = me.getPoleLatitude()
 latBoundaries = me.getPatchLatBoundaries()
 lngBoundaries = me.getPatchLngBoundaries()
 
-summits = pd.read_csv(me.summitFile)
+summits = me.readSummits(me.summitFile)
 
-summits['maxHorizonDistance'] = summits.elevation.apply(me.horizonDistance).astype(int)
+summits['maxHorizonDistance'] = me.horizonDistances(summits.elevation).astype('int32')
+
+# Sorted once so each patch finds its latitude band by binary search
+summits = summits.sort_values('latitude', kind='stable')
+globalMaxElevation = summits.elevation.max()
 
 # Bottom patch
-me.Patch(globalSummits = summits,
-         northInner = -poleLat,
-         southInner = -90)
+allPatchBounds = [(-poleLat, -90, None, None)]
 
 # Middle patches
 for lat in latBoundaries[:-1]:
     for lng in lngBoundaries[:-1]:
-        me.Patch(globalSummits = summits,
-                 northInner = lat + me.patchSize, 
-                 southInner = lat, 
-                 eastInner = lng + me.patchSize, 
-                 westInner = lng)
+        allPatchBounds.append((lat + me.patchSize, lat, lng + me.patchSize, lng))
 
 # Top patch
-me.Patch(globalSummits = summits,
-         northInner = 90,
-         southInner = poleLat)
\ No newline at end of file
+allPatchBounds.append((90, poleLat, None, None))
+
+# Forked workers share the sorted summits without pickling them
+with ProcessPoolExecutor(numWorkers, mp_context=multiprocessing.get_context('fork')) as executor:
+    list(executor.map(makePatch, allPatchBounds))
@@ -1,38 +1,107 @@
 import pandas as pd
 import commons as me
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 import os
 
+numWorkers = 1 # Candidates are split by patch across this many processes when > 1
+resume = True # Skip candidates already decided in the checkpoint file of a previous run
+sortCandidatesByPatch = True # Check candidates patch by patch so each patch is loaded once in serial runs
+
+checkpointFile = me.pinnaclePointFile.replace('.csv', '_checkpoint.csv')
+
 startTime = time.time()
 
-candidates = pd.read_csv(me.summitFile).query('candidate')
+candidates = me.readSummits(me.summitFile).query('candidate')
 
 candidates['pinnacle'] = None
 
 numCandidates = len(candidates)
-for i, candidate in enumerate(candidates.itertuples()):
 
-    print(f'Candidate: {i+1}/{numCandidates}\n')
-    
-    print(f'Location: {candidate.latitude}, {candidate.longitude}')
-    print(f'Elevation: {candidate.elevation} m\n')
+if resume and os.path.exists(checkpointFile) and os.path.getsize(checkpointFile) > 0:
+    decidedVerdicts = me.loadVerdicts(checkpointFile)
+    isDecided = candidates.summitId.isin(decidedVerdicts)
+    candidates.loc[isDecided, 'pinnacle'] = candidates.summitId[isDecided].map(decidedVerdicts)
+
+    with open(checkpointFile, 'rb+') as checkpoint:
+        checkpoint.seek(-1, os.SEEK_END)
+        if checkpoint.read(1) != b'\n':
+            checkpoint.write(b'\n')
+
+    print(f'Resuming with {isDecided.sum()}/{numCandidates} candidates already decided\n')
+else:
+    with open(checkpointFile, 'w') as checkpoint:
+        checkpoint.write(','.join(me.checkpointColumns) + '\n')
+
+undecidedCandidates = candidates[candidates.pinnacle.isna()]
+numDecided = numCandidates - len(undecidedCandidates)
+
+patchBounds = pd.Series([me.Summit(candidate.latitude, candidate.longitude, candidate.elevation).getPatchBounds()
+                         for candidate in undecidedCandidates.itertuples()], index=undecidedCandidates.index, dtype=object)
+candidatesByPatch = undecidedCandidates.groupby(patchBounds, sort=False)
+
+if sortCandidatesByPatch and numWorkers == 1 and len(undecidedCandidates) > 0:
+    undecidedCandidates = pd.concat([patchCandidates for _, patchCandidates in candidatesByPatch])
+
+if numWorkers == 1:
+
+    checkpoint = open(checkpointFile, 'a')
+
+    for i, candidate in enumerate(undecidedCandidates.itertuples()):
+
+        print(f'Candidate: {numDecided+i+1}/{numCandidates}\n')
+
+        print(f'Location: {candidate.latitude}, {candidate.longitude}')
+        print(f'Elevation: {candidate.elevation} m\n')
+
+        observer = me.Summit(summitId = candidate.summitId,
+                             latitude = candidate.latitude,
+                             longitude = candidate.longitude,
+                             elevation = candidate.elevation)
 
-    observer = me.Summit(summitId = candidate.summitId,
-                         latitude = candidate.latitude,
-                         longitude = candidate.longitude,
-                         elevation = candidate.elevation)
-    
-    candidateIsPinnaclePoint = observer.isPinnaclePoint()
+        candidateIsPinnaclePoint = observer.isPinnaclePoint()
 
-    candidates.loc[candidate.Index, 'pinnacle'] = candidateIsPinnaclePoint
-        
-    print(f'\n{len(candidates.query('pinnacle == True'))} pinnacle points found so far\n')
+        candidates.loc[candidate.Index, 'pinnacle'] = candidateIsPinnaclePoint
+        me.recordVerdict(checkpoint, candidate.summitId, candidateIsPinnaclePoint, observer.disqualifierId)
 
-    print('##################################################\n')
+        print(f'\n{len(candidates.query('pinnacle == True'))} pinnacle points found so far\n')
+
+        print('##################################################\n')
+
+    checkpoint.close()
+
+else:
+
+    if me.neighbourSource == 'index':
+        me.getSummitIndex() # Loaded once here and shared with the forked workers
+
+    numPatches = candidatesByPatch.ngroups
+    numChecked = numDecided
+
+    with ProcessPoolExecutor(numWorkers, mp_context=multiprocessing.get_context('fork')) as executor:
+
+        # Workers append each verdict to the checkpoint as soon as it is decided
+        futures = [executor.submit(me.findPinnaclePointsInPatch, bounds, patchCandidates, checkpointFile)
+                   for bounds, patchCandidates in candidatesByPatch]
+
+        for i, future in enumerate(as_completed(futures)):
+
+            results, cacheCounts = future.result()
+
+            for index, candidateIsPinnaclePoint, disqualifierId in results:
+                candidates.loc[index, 'pinnacle'] = candidateIsPinnaclePoint
+                numChecked += 1
+
+            if me.useElevationCache:
+                me.getElevationCache().addCounts(cacheCounts)
+
+            print(f'\nPatches: {i+1}/{numPatches}, Candidates: {numChecked}/{numCandidates}')
+            print(f'{len(candidates.query('pinnacle == True'))} pinnacle points found so far\n')
 
 pinnaclePoints = candidates.query('pinnacle == True')[['summitId', 'latitude', 'longitude', 'elevation']]
 
-pinnaclePoints.to_csv(me.pinnaclePointFile, index=False)
+me.writeSummits(pinnaclePoints, me.pinnaclePointFile, index=False)
 
 endTime = time.time()
 totalTime = round(endTime - startTime)
@@ -42,4 +111,7 @@ hours = (totalTime % 86400) // 3600
 minutes = (totalTime % 3600) // 60
 seconds = totalTime % 60
 
+if me.useElevationCache:
+    print(me.getElevationCache())
+
 print(f'{len(pinnaclePoints)} pinnacle points found in {days}d {hours}h {minutes}m {seconds}s!')
@@ -1,7 +1,8 @@
 import pandas as pd
+import commons as me
 
-prm = pd.read_csv('../data/results/pinnacle_points/prm/pinnacle_points.csv')
-iso = pd.read_csv('../data/results/pinnacle_points/iso/pinnacle_points.csv')
+prm = me.readSummits('../data/results/pinnacle_points/prm/pinnacle_points.csv')
+iso = me.readSummits('../data/results/pinnacle_points/iso/pinnacle_points.csv')
 
 iso['summitId'] = -iso.summitId
 pinnaclePoints = pd.concat([prm, iso])
@@ -13,4 +14,4 @@ pinnaclePoints = (pinnaclePoints.sort_values(by=['latitude', 'longitude', 'eleva
 
 pinnaclePoints = pinnaclePoints.sort_values('elevation', ascending=False)
 
-pinnaclePoints.to_csv('../data/results/pinnacle_points/prm_iso/pinnacle_points_merged.csv', index=False)
\ No newline at end of file
+me.writeSummits(pinnaclePoints, '../data/results/pinnacle_points/prm_iso/pinnacle_points_merged.csv', index=False)
\ No newline at end of file
@@ -2,89 +2,187 @@ import pandas as pd
 import numpy as np
 import commons as me
 import time
+import os
+import heapq
+import shutil
+import itertools
 
-def getBatchSummitElevations(batchSummits):
-    
-    latitudes = np.array(batchSummits.latitude)
-    longitudes = np.array(batchSummits.longitude)
-    elevations = np.array(batchSummits.elevation)
+refreshChunkSize = 1000000 # Summits per getElevations call, the API client splits them into concurrent requests
+outputChunkSize = 1000000 # Rows per write when saving the clean summits
 
-    apiElevations = me.getElevations(latitudes, longitudes)
+# The raw lists are read, cleaned and sorted this many rows at a time, then merged by elevation from disk
+ingestChunkSize = 1000000
+chunkDirectory = '../data/clean/chunks'
 
-    updatedElevations = []
-    for i, apiElevation in enumerate(apiElevations): 
-        if apiElevation > elevations[i]:
-            elevations[i] = apiElevation
+def refreshSummitElevations(summits):
 
-    batchSummits.elevation = elevations
-    return batchSummits
+    numSummits = len(summits)
 
-def getSummitElevationsInBatches(summits):
+    latitudes = summits.latitude.to_numpy()
+    longitudes = summits.longitude.to_numpy()
+    refreshedElevations = np.empty(numSummits)
 
-    numSummits = len(summits)
-    
-    batches = np.array_split(summits, len(summits) // me.apiRequestLimit + 1)
+    refreshStartTime = time.time()
+    for start in range(0, numSummits, refreshChunkSize):
+
+        end = min(start + refreshChunkSize, numSummits)
+        refreshedElevations[start:end] = me.getElevations(latitudes[start:end], longitudes[start:end])
 
-    processedBatches = []
-    for i, batch in enumerate(batches):
+        rate = end / max(time.time() - refreshStartTime, 1e-9)
+        print(f'Processed elevations for {end}/{numSummits} summits ({round(rate)} summits/s)')
 
-        if i%10000 == 0:
-            print(f'Processed elevations for {i*me.apiRequestLimit}/{numSummits} summits')
-  
-        processedBatches.append(getBatchSummitElevations(batch))
-    
-    return pd.concat(processedBatches, ignore_index=True)
+    # Summits only ever get higher, missing elevations (nan) keep the listed elevation
+    elevations = summits.elevation.to_numpy()
+    summits['elevation'] = np.fmax(elevations, refreshedElevations).astype(elevations.dtype)
+
+    return summits.reset_index(drop=True)
 
 def fixBigBadElevations(df, ids):
-    
+
     subset = df.loc[ids]
     lats = subset.latitude.tolist()
     lngs = subset.longitude.tolist()
     elevations = me.getElevations(lats, lngs)
-    df.loc[ids, 'elevation'] = elevations
+
+    # Elevations come back as float64, pandas refuses values the float32 column can not hold exactly
+    df.loc[ids, 'elevation'] = np.asarray(elevations).astype(df.elevation.dtype)
+
+def getRowHashes(summits, columns):
+    # 64 bit hash per row, the same values always hash the same between chunks
+    return pd.util.hash_pandas_object(summits[columns], index=False).to_numpy()
+
+def isInSortedHashes(hashes, sortedHashes):
+    if len(sortedHashes) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    positions = np.minimum(np.searchsorted(sortedHashes, hashes), len(sortedHashes) - 1)
+    return sortedHashes[positions] == hashes
+
+def dropSeenDuplicates(summits, seenHashes):
+
+    # Rows are hashed with the dtypes they were read with (float64), like drop_duplicates on the whole list
+    hashes = getRowHashes(summits, list(summits.columns))
+
+    # seenHashes keeps the sorted hashes of every earlier chunk as their own array, so nothing is ever sorted twice
+    isNew = ~pd.Series(hashes).duplicated().to_numpy()
+    for chunkHashes in seenHashes:
+        isNew &= ~isInSortedHashes(hashes, chunkHashes)
+    seenHashes.append(np.sort(hashes[isNew]))
+
+    return summits[isNew].copy()
+
+def saveSortedChunk(summits, chunkNumber):
+
+    summits = summits.sort_values('elevation', ascending=False, kind='stable')
+
+    chunkPath = f'{chunkDirectory}/{chunkNumber}'
+    os.makedirs(chunkPath, exist_ok=True)
+    for column in summits.columns:
+        np.save(f'{chunkPath}/{column}.npy', summits[column].to_numpy())
+
+def getChunkKeys(elevations, chunkNumber, blockSize=65536):
+    # Ties keep the order the summits were read in, like a stable sort of the whole list
+    for start in range(0, len(elevations), blockSize):
+        negativeElevations = -np.asarray(elevations[start : start+blockSize], dtype=float)
+        yield from zip(negativeElevations.tolist(), itertools.repeat(chunkNumber), range(start, start+len(negativeElevations)))
+
+def mergeSortedChunks(numChunks, columns, outputFile, elevationFixes=None):
+
+    chunks = [{column: np.load(f'{chunkDirectory}/{chunkNumber}/{column}.npy', mmap_mode='r') for column in columns}
+              for chunkNumber in range(numChunks)]
+
+    mergedKeys = heapq.merge(*[getChunkKeys(chunk['elevation'], chunkNumber) for chunkNumber, chunk in enumerate(chunks)])
+
+    # Elevation fixes are found by coordinates, equal elevations make positions in the sorted list ambiguous
+    elevationFixHashes = np.array([], dtype='uint64')
+    if elevationFixes is not None:
+        elevationFixHashes = np.sort(getRowHashes(elevationFixes, ['latitude', 'longitude']))
+
+    numSummits = 0
+    numCandidates = 0
+    firstSummit = None
+
+    while True:
+
+        blockKeys = list(itertools.islice(mergedKeys, outputChunkSize))
+        if len(blockKeys) == 0:
+            break
+
+        _, chunkNumbers, rows = (np.array(keys) for keys in zip(*blockKeys))
+
+        blockColumns = {column: np.empty(len(blockKeys), dtype=chunks[0][column].dtype) for column in columns}
+        for chunkNumber in np.unique(chunkNumbers):
+            isInChunk = chunkNumbers == chunkNumber
+            for column in columns:
+                blockColumns[column][isInChunk] = chunks[chunkNumber][column][rows[isInChunk]]
+
+        block = pd.DataFrame(blockColumns, index=pd.RangeIndex(numSummits, numSummits + len(blockKeys)))
+
+        # Fixed summits keep their place in the sorted list, like when the fixes were applied after the sort
+        blockElevationFixIds = list(block.index[isInSortedHashes(getRowHashes(block, ['latitude', 'longitude']), elevationFixHashes)])
+        if len(blockElevationFixIds) > 0:
+            fixBigBadElevations(block, blockElevationFixIds)
+
+        me.writeSummits(block, outputFile, index_label='summitId', mode='w' if numSummits == 0 else 'a', header=numSummits == 0)
+
+        if firstSummit is None:
+            firstSummit = block.head(1)
+
+        numSummits += len(block)
+        numCandidates += block.candidate.sum()
+
+    return numSummits, numCandidates, firstSummit
 
 startTime = time.time()
 
 print('PROMINENCE SUMMITS\n')
 
-ototw = pd.read_csv('../data/raw/ototw_p300m.csv')
-ototw = ototw[['latitude', 'longitude', 'elevation_m', 'prominence_m']]
+ototw = pd.read_csv('../data/raw/ototw_p300m.csv', usecols=['latitude', 'longitude'], dtype={'latitude': 'float64', 'longitude': 'float64'})
+
+# For some reason the co-ords for the first 2 summits don't match exactly between OTOTW and Every_Mountain_in_the_World,
+# and Grove Hill is missing from OTOTW (summitId 7763206 in the published results)
+manualCandidates = pd.DataFrame({'latitude': [-10.8881, 47.1803, 44.1381], 'longitude': [27.5494, 7.305, -85.3444]})
+
+# Candidates are tagged by coordinates, a summit matching several OTOTW rows is still only listed once
+candidateHashes = np.sort(getRowHashes(pd.concat([ototw, manualCandidates]), ['latitude', 'longitude']))
 
 prmSummitColNames = ['latitude', 'longitude', 'elevation', 'key_saddle_latitude', 'key_saddle_longitude', 'prominence']
-prmSummits = pd.read_csv('../data/raw/all-peaks-sorted-p100.txt', names=prmSummitColNames)
+prmSummitDtypes = {'latitude': 'float64', 'longitude': 'float64', 'elevation': 'float64', 'prominence': 'float64'}
+prmSummitChunks = pd.read_csv('../data/raw/all-peaks-sorted-p100.txt', names=prmSummitColNames, usecols=list(prmSummitDtypes),
+                              dtype=prmSummitDtypes, chunksize=ingestChunkSize)
+
+startingNumPrmSummits = 0
+seenHashes = []
+
+shutil.rmtree(chunkDirectory, ignore_errors=True)
 
-startingNumPrmSummits = len(prmSummits)
+for chunkNumber, prmSummits in enumerate(prmSummitChunks):
 
-prmSummits = prmSummits[['latitude', 'longitude', 'elevation', 'prominence']]
+    startingNumPrmSummits += len(prmSummits)
 
-prmSummits = prmSummits.drop_duplicates()
+    prmSummits = prmSummits[['latitude', 'longitude', 'elevation', 'prominence']]
 
-prmSummits = prmSummits.merge(ototw[['latitude', 'longitude']], on=['latitude', 'longitude'], how='left', indicator='temp_merge')
-prmSummits['candidate'] = prmSummits['temp_merge'].eq('both')
-prmSummits = prmSummits.drop(columns=['temp_merge'])
+    prmSummits = dropSeenDuplicates(prmSummits, seenHashes)
+    prmSummits = prmSummits.astype({'elevation': 'float32', 'prominence': 'float32'})
 
-# For some reason the co-ords for these 2 summits don't match exactly between OTOTW and Every_Mountain_in_the_World
-prmSummits.loc[[266009, 532994], 'candidate'] = True
+    prmSummits['candidate'] = isInSortedHashes(getRowHashes(prmSummits, ['latitude', 'longitude']), candidateHashes)
 
-prmSummits.loc[prmSummits['longitude'] == 180.0, 'longitude'] -= 0.0001
+    prmSummits.loc[prmSummits['longitude'] == 180.0, 'longitude'] -= 0.0001
 
-prmSummits = getSummitElevationsInBatches(prmSummits)
-prmSummits = prmSummits.sort_values('elevation', ascending=False)
-prmSummits = prmSummits.reset_index(drop=True)
+    prmSummits = refreshSummitElevations(prmSummits)
+    saveSortedChunk(prmSummits, chunkNumber)
 
-# TODO: Add comment, Grove hill, gotta redo Ids now
-prmSummits.loc[[7763206], 'candidate'] = True
+print('\nMerging sorted chunks')
 
-endingNumPrmSummits = len(prmSummits)
+endingNumPrmSummits, numPrmCandidates, everest = mergeSortedChunks(chunkNumber + 1, ['latitude', 'longitude', 'elevation', 'prominence', 'candidate'],
+                                                                   f'../data/clean/summits_prm.csv')
+
+shutil.rmtree(chunkDirectory)
 
 print(f'\nSummits before clean-up: {startingNumPrmSummits}')
 print(f'Summits after clean-up: {endingNumPrmSummits} ({startingNumPrmSummits-endingNumPrmSummits} removed)')
 
-numPrmCandidates = len(prmSummits.query('candidate == True'))
 print(f'Number of Candidates: {numPrmCandidates} ({round(100*numPrmCandidates/endingNumPrmSummits, 3)}%)')
 
-prmSummits.to_csv(f'../data/clean/summits_prm.csv', index_label='summitId')
-
 print('\n##################################################\n')
 
 print('ISOLATION SUMMITS\n')
@@ -92,50 +190,59 @@ print('ISOLATION SUMMITS\n')
 isolationCadidateThresholdKm = 100 # in km
 
 isoColNames = ['latitude', 'longitude', 'elevation_ft', 'ILP_latitude', 'ILP_longitude', 'isolation_km']
-isoSummits = pd.read_csv('../data/raw/alliso-sorted.txt', names=isoColNames)
+isoDtypes = {'latitude': 'float64', 'longitude': 'float64', 'elevation_ft': 'float64', 'isolation_km': 'float64'}
+isoSummitChunks = pd.read_csv('../data/raw/alliso-sorted.txt', names=isoColNames, usecols=list(isoDtypes),
+                              dtype=isoDtypes, chunksize=ingestChunkSize)
 
-startingNumIsoSummits = len(isoSummits)
+# Adding Everest, as its own chunk so it is never dropped as a duplicate
+everestIsoData = pd.DataFrame({'latitude': everest.latitude.to_numpy(),
+                               'longitude': everest.longitude.to_numpy(),
+                               'elevation': everest.elevation.to_numpy(dtype='float32'),
+                               'isolation': [np.nan],
+                               'candidate': [True]})
+everestIsoData.loc[everestIsoData['longitude'] == 180.0, 'longitude'] -= 0.0001
+saveSortedChunk(refreshSummitElevations(everestIsoData), 0)
 
-isoSummits['elevation'] = isoSummits.elevation_ft.divide(3.28084).round(2)
-isoSummits['isolation'] = isoSummits.isolation_km.multiply(1000).round(2)
+# Summits listed far higher than they are (summitIds 342 and 13154544 in the published results)
+isoElevationFixes = pd.DataFrame({'latitude': [33.9233, 29.8958], 'longitude': [89.2108, -89.9983]})
 
-isoSummits = isoSummits[['latitude', 'longitude', 'elevation', 'isolation']]
+startingNumIsoSummits = 0
+seenHashes = []
 
-isoSummits = isoSummits.drop_duplicates()
+for chunkNumber, isoSummits in enumerate(isoSummitChunks, 1):
 
-# There should not be any isolation less than 1 km (https://www.andrewkirmse.com/true-isolation)
-isoSummits = isoSummits.query('isolation >= 1000') 
+    startingNumIsoSummits += len(isoSummits)
 
-isoSummits['candidate'] = (isoSummits.isolation > isolationCadidateThresholdKm*1000) & (isoSummits.elevation > 0)
+    isoSummits['elevation'] = isoSummits.elevation_ft.divide(3.28084).round(2)
+    isoSummits['isolation'] = isoSummits.isolation_km.multiply(1000).round(2) # Up to half the earth's circumference, too big for float32
 
-# Adding Everest
-everest = prmSummits.head(1)
-everestIsoData = [everest.latitude.values[0], 
-                  everest.longitude.values[0], 
-                  everest.elevation.values[0], 
-                  None,
-                  True]
-everestIsoData = pd.DataFrame([everestIsoData], columns=isoSummits.columns)
-isoSummits = pd.concat([everestIsoData, isoSummits], ignore_index=True)
+    isoSummits = isoSummits[['latitude', 'longitude', 'elevation', 'isolation']]
 
-isoSummits.loc[isoSummits['longitude'] == 180.0, 'longitude'] -= 0.0001
+    isoSummits = dropSeenDuplicates(isoSummits, seenHashes)
+    isoSummits = isoSummits.astype({'elevation': 'float32'})
 
-isoSummits = getSummitElevationsInBatches(isoSummits)
-isoSummits = isoSummits.sort_values('elevation', ascending=False)
-isoSummits = isoSummits.reset_index(drop=True)
+    # There should not be any isolation less than 1 km (https://www.andrewkirmse.com/true-isolation)
+    isoSummits = isoSummits.query('isolation >= 1000')
 
-fixBigBadElevations(isoSummits, [342, 13154544])
+    isoSummits['candidate'] = (isoSummits.isolation > isolationCadidateThresholdKm*1000) & (isoSummits.elevation > 0)
 
-endingNumIsoSummits = len(isoSummits)
+    isoSummits.loc[isoSummits['longitude'] == 180.0, 'longitude'] -= 0.0001
+
+    isoSummits = refreshSummitElevations(isoSummits)
+    saveSortedChunk(isoSummits, chunkNumber)
+
+print('\nMerging sorted chunks')
+
+endingNumIsoSummits, numIsoCandidates, _ = mergeSortedChunks(chunkNumber + 1, ['latitude', 'longitude', 'elevation', 'isolation', 'candidate'],
+                                                             f'../data/clean/summits_iso.csv', elevationFixes=isoElevationFixes)
+
+shutil.rmtree(chunkDirectory)
 
 print(f'\nSummits before clean-up: {startingNumIsoSummits}')
 print(f'Summits after clean-up: {endingNumIsoSummits} ({startingNumIsoSummits-endingNumIsoSummits-1} removed, 1 added)')
 
-numIsoCandidates = len(isoSummits.query('candidate == True'))
 print(f'Number of Candidates: {numIsoCandidates} ({round(100*numIsoCandidates/endingNumIsoSummits, 3)}%)')
 
-isoSummits.to_csv(f'../data/clean/summits_iso.csv', index_label='summitId')
-
 print('\n##################################################\n')
 
 endTime = time.time()
@@ -146,4 +253,4 @@ hours = (totalTime % 86400) // 3600
 minutes = (totalTime % 3600) // 60
 seconds = totalTime % 60
 
-print(f'\n{days}d {hours}h {minutes}m {seconds}s to clean all {startingNumPrmSummits+startingNumIsoSummits} summits!')
\ No newline at end of file
+print(f'\n{days}d {hours}h {minutes}m {seconds}s to clean all {startingNumPrmSummits+startingNumIsoSummits} summits!')
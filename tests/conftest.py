@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+# The scripts import each other as plain modules, e.g. import commons as me
+scriptsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.insert(0, scriptsDirectory)
+
+import commons as me
+
+# Replaces the elevation source named by the test module's fetchedSource with its getFakeElevations,
+# and records every point that is fetched
+@pytest.fixture
+def fetchedPoints(request, monkeypatch):
+
+    fetchedPoints = []
+    getFakeElevations = request.module.getFakeElevations
+    def getRecordedElevations(latitudes, longitudes):
+        fetchedPoints.extend(zip(latitudes, longitudes))
+        return getFakeElevations(latitudes, longitudes)
+
+    monkeypatch.setattr(me, request.module.fetchedSource, getRecordedElevations)
+    return fetchedPoints
@@ -0,0 +1,28 @@
+import commons as me
+
+def writeCheckpoint(path, lines):
+    with open(path, 'w') as checkpoint:
+        checkpoint.write(','.join(me.checkpointColumns) + '\n')
+        checkpoint.write(lines)
+
+def test_recorded_verdicts_are_loaded(tmp_path):
+    checkpointFile = tmp_path / 'checkpoint.csv'
+    writeCheckpoint(checkpointFile, '')
+
+    with open(checkpointFile, 'a') as checkpoint:
+        me.recordVerdict(checkpoint, 12, True, None)
+        me.recordVerdict(checkpoint, 34, False, 56)
+        me.recordVerdict(checkpoint, -78, False, -9)
+
+    assert me.loadVerdicts(checkpointFile) == {12: True, 34: False, -78: False}
+
+def test_torn_lines_are_not_trusted(tmp_path):
+    checkpointFile = tmp_path / 'checkpoint.csv'
+    writeCheckpoint(checkpointFile,
+                    '12,True,,True\n'
+                    '34,False,6\n'      # disqualifierId truncated before the last column
+                    '35,False,67,Tr\n'  # last column truncated
+                    '36,Fal37,False,8,True\n' # torn line run into the next one
+                    '38,False,89,True')
+
+    assert me.loadVerdicts(checkpointFile) == {12: True, 38: False}
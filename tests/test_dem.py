@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+import commons as me
+
+@pytest.fixture
+def demDirectory(tmp_path, monkeypatch):
+    monkeypatch.setattr(me, 'demDirectory', str(tmp_path))
+    monkeypatch.setattr(me, 'demTiles', {})
+    return tmp_path
+
+def test_elevations_are_interpolated_in_a_square_tile(demDirectory):
+    # Elevation rises by 1 m per row southward and 10 m per column eastward
+    rows, cols = np.meshgrid(np.arange(1201), np.arange(1201), indexing='ij')
+    (rows + 10*cols).astype('>i2').tofile(demDirectory / 'N45W122.hgt')
+
+    elevations = me.getDemElevations([45.5, 45.95, 10], [-121.99975, -121.99975, 0])
+    np.testing.assert_allclose(elevations, [600 + 3, 60 + 3, 0])
+
+@pytest.mark.parametrize('shape', [(1201, 601), (3601, 1801)])
+def test_tile_that_is_not_a_square_hgt_grid_is_refused(demDirectory, shape):
+    np.zeros(shape, dtype='>i2').tofile(demDirectory / 'N45W122.hgt')
+
+    with pytest.raises(ValueError, match='not a square HGT tile'):
+        me.getDemElevations([45.5], [-121.5])
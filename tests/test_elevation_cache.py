@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import commons as me
+
+fetchedSource = 'getUncachedElevations'
+
+def getFakeElevations(latitudes, longitudes):
+    # Voids (nan) south of the equator
+    return np.where(np.asarray(latitudes) < 0, np.nan, 100 + np.asarray(longitudes))
+
+@pytest.fixture(autouse=True)
+def elevationCacheFile(tmp_path, monkeypatch):
+    monkeypatch.setattr(me, 'elevationCacheFile', str(tmp_path / 'elevations.sqlite'))
+
+def test_voids_are_cached(fetchedPoints):
+    cache = me.ElevationCache()
+    latitudes = np.array([-10, 10, -20])
+    longitudes = np.array([1, 2, 3])
+
+    firstElevations = cache.getElevations(latitudes, longitudes)
+    secondElevations = cache.getElevations(latitudes, longitudes)
+
+    np.testing.assert_array_equal(firstElevations, secondElevations)
+    assert np.isnan(secondElevations[[0, 2]]).all()
+    assert len(fetchedPoints) == 3
+    assert list(cache.getCounts()) == [3, 0, 3]
+
+    # Voids come back from the SQLite file as well
+    diskCache = me.ElevationCache()
+    np.testing.assert_array_equal(diskCache.getElevations(latitudes, longitudes), firstElevations)
+    assert len(fetchedPoints) == 3
+    assert list(diskCache.getCounts()) == [0, 3, 0]
+
+def test_memory_is_evicted_by_size(fetchedPoints, monkeypatch):
+    monkeypatch.setattr(me, 'elevationCacheMemorySize', 10*me.elevationCacheEntrySize)
+    cache = me.ElevationCache()
+
+    cache.getElevations(np.linspace(1, 2, 25), np.linspace(1, 2, 25))
+
+    assert len(cache.memory) == 10
+    assert cache.getMemoryUsage() <= me.elevationCacheMemorySize
+
+def test_counts_add_up(fetchedPoints):
+    cache = me.ElevationCache()
+    cache.addCounts(np.array([1, 2, 3]))
+    cache.addCounts(np.array([4, 5, 6]))
+    assert list(cache.getCounts()) == [5, 7, 9]
@@ -0,0 +1,193 @@
+import math
+import numpy as np
+import pytest
+import commons as me
+
+def getTerrainElevations(latitudes, longitudes):
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    return 300 + 900*np.sin(latitudes*9)*np.cos(longitudes*7) + 400*np.sin(latitudes*40 + longitudes*33)
+
+@pytest.fixture(autouse=True)
+def terrain(monkeypatch):
+    monkeypatch.setattr(me, 'getElevations', getTerrainElevations)
+
+def getLinesOfSight(numPairs, seed=0):
+
+    rng = np.random.default_rng(seed)
+    observerLatitudes = rng.uniform(40, 50, numPairs)
+    observerLongitudes = rng.uniform(0, 15, numPairs)
+    targetLongitudes, targetLatitudes, _ = me.geod.fwd(observerLongitudes, observerLatitudes,
+                                                       rng.uniform(0, 360, numPairs), rng.uniform(15000, 150000, numPairs))
+
+    observerElevations = getTerrainElevations(observerLatitudes, observerLongitudes) + rng.uniform(0, 2500, numPairs)
+    targetElevations = getTerrainElevations(targetLatitudes, targetLongitudes) + rng.uniform(0, 2500, numPairs)
+
+    return [me.LineOfSight(me.Summit(*observer), me.Summit(*target)) for observer, target in
+            zip(zip(observerLatitudes, observerLongitudes, observerElevations), zip(targetLatitudes, targetLongitudes, targetElevations))]
+
+def getBatch(linesOfSight):
+    observers = me.Point(latitude = np.array([los.observer.latitude for los in linesOfSight]),
+                         longitude = np.array([los.observer.longitude for los in linesOfSight]),
+                         elevation = np.array([los.observer.elevation for los in linesOfSight]))
+    targets = me.Point(latitude = np.array([los.target.latitude for los in linesOfSight]),
+                       longitude = np.array([los.target.longitude for los in linesOfSight]),
+                       elevation = np.array([los.target.elevation for los in linesOfSight]))
+    return me.LineOfSightBatch(observers, targets)
+
+# The per point profile and adaptive quadrature contrast of LineOfSight before it was routed through LineOfSightBatch
+def getReferenceVerdict(los):
+
+    lngLats = np.array(me.geod.npts(los.observer.longitude, los.observer.latitude, los.target.longitude, los.target.latitude, los.numSamples)).reshape(-1, 2)
+    latitudes = np.concatenate([[los.observer.latitude], lngLats[:, 1], [los.target.latitude]])
+    longitudes = np.concatenate([[los.observer.longitude], lngLats[:, 0], [los.target.longitude]])
+    elevations = np.concatenate([[los.observer.elevation], getTerrainElevations(lngLats[:, 1], lngLats[:, 0]), [los.target.elevation]])
+
+    surfaceDistances = np.array([me.geod.line_length([los.observer.longitude, longitude], [los.observer.latitude, latitude])
+                                 for latitude, longitude in zip(latitudes, longitudes)])
+
+    angles = surfaceDistances/me.earthRadius
+    xDistances = me.earthRadius * np.sin(angles)
+    yHeights = elevations - me.earthRadius * (1 - np.cos(angles)) - elevations[0]
+
+    angleBelowHorizontal = -np.arctan(yHeights[-1]/xDistances[-1])
+    rotationMatrix = np.array([[math.cos(angleBelowHorizontal), -math.sin(angleBelowHorizontal)],
+                               [math.sin(angleBelowHorizontal),  math.cos(angleBelowHorizontal)]])
+    straightDistances, groundHeights = rotationMatrix @ np.array([xDistances, yHeights])
+
+    distanceToTarget = straightDistances[-1]
+    gamma = (los.lightCurvature*me.earthRadius)**2 - distanceToTarget**2
+    lightHeights = np.sqrt(gamma + straightDistances*(distanceToTarget - straightDistances)) - np.sqrt(gamma)
+
+    isChecked = (straightDistances > me.ignoreBuffer) & (straightDistances < distanceToTarget - me.ignoreBuffer)
+    excessHeights = groundHeights[isChecked] - lightHeights[isChecked]
+    maxExcessHeight = excessHeights.max() if len(excessHeights) > 0 else -np.inf
+
+    return maxExcessHeight, los.getQuadContrast()
+
+def test_line_of_sight_matches_reference():
+
+    linesOfSight = getLinesOfSight(200)
+    numObstructed = 0
+
+    for los in linesOfSight:
+
+        maxExcessHeight, quadContrast = getReferenceVerdict(los)
+        los.processFullLineOfSight()
+
+        # Sample positions of geod.npts and getGreatCirclePoints agree to well under a metre of ground
+        if abs(maxExcessHeight) > 1:
+            assert(los.isObstructed() == (maxExcessHeight >= 0))
+        numObstructed += los.isObstructed()
+
+        assert(los.getContrast() == pytest.approx(quadContrast, rel=1e-6))
+        assert(len(los.elevations) == los.numSamples + 2)
+
+    assert(0 < numObstructed < len(linesOfSight))
+
+def test_progressive_line_of_sight_matches_full():
+
+    for los in getLinesOfSight(100, seed=1):
+
+        fullLos = me.LineOfSight(los.observer, los.target)
+        fullLos.processFullLineOfSight()
+        los.processProgressiveLineOfSight()
+
+        assert(los.isValid() == fullLos.isValid())
+        if not los.isObstructed():
+            assert(np.array_equal(los.elevations, fullLos.elevations))
+
+def test_line_of_sight_is_a_batch_of_one():
+
+    linesOfSight = getLinesOfSight(50, seed=2)
+    for los in linesOfSight:
+        los.processFullLineOfSight()
+
+    batch = getBatch(linesOfSight)
+    batch.process()
+
+    assert(np.array_equal(batch.isObstructed(), [los.isObstructed() for los in linesOfSight]))
+    assert(np.allclose(batch.getContrasts(), [los.getContrast() for los in linesOfSight]))
+
+    obstructionDistances, _ = batch.getObstructionPoints()
+    for los, obstructionDistance in zip(linesOfSight, obstructionDistances):
+        obstructionPoint = los.getObstructionPoint()
+        assert((obstructionPoint is None) == np.isnan(obstructionDistance))
+        if obstructionPoint is not None:
+            assert(obstructionPoint[0] == obstructionDistance)
+
+@pytest.mark.parametrize('strides', [[32, 1], [64, 8, 1], [7, 1]])
+def test_progressive_strides_give_full_sampling_verdicts(strides):
+
+    linesOfSight = getLinesOfSight(300, seed=3)
+    fullBatch = getBatch(linesOfSight)
+    fullBatch.process()
+    progressiveBatch = getBatch(linesOfSight)
+    progressiveBatch.process(strides)
+
+    assert(np.array_equal(progressiveBatch.isValid(), fullBatch.isValid()))
+    assert(np.array_equal(progressiveBatch.isObstructed(), fullBatch.isObstructed()))
+
+    # Open pairs end up fully sampled, obstructed ones stop early
+    isFetched = ~np.isnan(progressiveBatch.sampleElevations)
+    isValid = progressiveBatch.isValid()[progressiveBatch.pairIds]
+    assert(isFetched[isValid].all())
+    assert(isFetched.sum() < (~np.isnan(fullBatch.sampleElevations)).sum())
+
+@pytest.mark.parametrize('lightCurvature, shadedRatio, shadeIrradiationRatio', [(6.4, 0.5, 0.5), (4, 0.2, 0), (10, 0.8, 1), (6.4, 0, 0.5), (6.4, 1, 0.5)])
+def test_gauss_legendre_contrast_matches_quad(lightCurvature, shadedRatio, shadeIrradiationRatio):
+
+    # Pairs from a few km up to 900 km, at sea level up to the height of Everest
+    rng = np.random.default_rng(4)
+    numPairs = 100
+    distances = np.exp(rng.uniform(np.log(5000), np.log(900000), numPairs))
+    targetLongitudes, targetLatitudes, _ = me.geod.fwd(np.zeros(numPairs), np.zeros(numPairs), rng.uniform(0, 360, numPairs), distances)
+    observers = me.Point(np.zeros(numPairs), np.zeros(numPairs), rng.uniform(0, 8849, numPairs))
+    targets = me.Point(targetLatitudes, targetLongitudes, rng.uniform(0, 8849, numPairs))
+
+    contrasts = me.LineOfSightBatch(observers, targets, lightCurvature, shadedRatio=shadedRatio, shadeIrradiationRatio=shadeIrradiationRatio).getContrasts()
+
+    for i, contrast in enumerate(contrasts):
+        los = me.LineOfSight(me.Summit(observers.latitude[i], observers.longitude[i], observers.elevation[i]),
+                             me.Summit(targets.latitude[i], targets.longitude[i], targets.elevation[i]),
+                             lightCurvature, shadedRatio=shadedRatio, shadeIrradiationRatio=shadeIrradiationRatio)
+        assert(contrast == pytest.approx(los.getQuadContrast(), rel=1e-9, abs=1e-12))
+
+# The scalar light and straight line elevations of LineOfSight before they were vectorized
+def getReferenceElevations(h1, h2, D, x, C=me.defaultLightCurvature):
+
+    R = me.earthRadius
+    theta = x/R
+    phi = D/R
+
+    x1, y1 = R + h1, 0
+    x2, y2 = (R + h2)*math.cos(phi), (R + h2)*math.sin(phi)
+
+    d = math.sqrt((x2-x1)**2 + (y2-y1)**2)
+    RL = C*R
+    Z = math.sqrt(RL**2 - (d/2)**2)
+    Mx = (x1+x2)/2 - Z*((y2-y1)/d)
+    My = (y1+y2)/2 + Z*((x2-x1)/d)
+    lightElevation = (Mx*math.cos(theta) + My*math.sin(theta)) + math.sqrt((Mx*math.cos(theta) + My*math.sin(theta))**2 - (Mx**2 + My**2 - RL**2)) - R
+
+    m = (x2 - x1)/(y2 - y1) if y2 != y1 else 1
+    straightElevation = x1/(math.cos(theta) - m*math.sin(theta)) - R
+
+    return lightElevation, straightElevation
+
+def test_vectorized_light_geometry_matches_scalar():
+
+    rng = np.random.default_rng(5)
+    numPairs = 200
+    observerElevations = rng.uniform(0, 8849, numPairs)
+    targetElevations = rng.uniform(0, 8849, numPairs)
+    surfaceDistances = rng.uniform(5000, 900000, numPairs)
+    x = surfaceDistances*rng.uniform(0, 1, numPairs)
+
+    lightElevations = me.getLightElevations(me.getLightCircles(observerElevations, targetElevations, surfaceDistances), x)
+    straightElevations = me.getStraightElevations(observerElevations, targetElevations, surfaceDistances, x)
+
+    for i in range(numPairs):
+        lightElevation, straightElevation = getReferenceElevations(observerElevations[i], targetElevations[i], surfaceDistances[i], x[i])
+        assert(lightElevations[i] == pytest.approx(lightElevation, abs=1e-6))
+        assert(straightElevations[i] == pytest.approx(straightElevation, abs=1e-6))
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+import commons as me
+
+def getSummits(latitudes, longitudes, elevations):
+    summits = pd.DataFrame({'summitId': np.arange(len(latitudes)),
+                            'latitude': np.asarray(latitudes, dtype=float),
+                            'longitude': np.asarray(longitudes, dtype=float),
+                            'elevation': np.asarray(elevations, dtype='float32')})
+    summits['maxHorizonDistance'] = me.horizonDistances(summits.elevation).astype('int32')
+    return summits
+
+def test_global_summits_must_be_sorted_by_latitude(tmp_path, monkeypatch):
+    monkeypatch.setattr(me, 'patchDirectory', str(tmp_path))
+    summits = getSummits([55, 52], [5, 5], [1000, 2000])
+
+    with pytest.raises(AssertionError):
+        me.Patch(60, 50, 10, 0, globalSummits=summits)
+
+def getBruteForceDisqualifiers(summit, summits):
+    # Same rule as Summit.getPossibleDisqualifiers, over every summit instead of a patch
+    distances = np.round(me.getDistances(summit.latitude, summit.longitude, summits.latitude, summits.longitude))
+    isDisqualifier = ((summits.summitId.to_numpy() != summit.summitId)
+                      & (summits.elevation.to_numpy() > summit.elevation)
+                      & (distances < summits.maxHorizonDistance.to_numpy() + summit.getMaxHorizonDistance()))
+    return set(summits.summitId[isDisqualifier])
+
+def getPatchDisqualifiers(patch, summits):
+    # Possible disqualifiers of every inner summit of the patch, by summitId
+    disqualifiers = {}
+    for summit in summits.itertuples():
+        observer = me.Summit(summit.latitude, summit.longitude, float(summit.elevation), summitId=summit.summitId)
+        if observer.getPatchBounds() == (patch.northInner, patch.southInner, patch.eastInner, patch.westInner):
+            disqualifiers[summit.summitId] = set(observer.getPossibleDisqualifiers(patch).summitId)
+    return disqualifiers
+
+def makePatch(summits, patchBounds):
+    summits = summits.sort_values('latitude', kind='stable')
+    return me.Patch(*patchBounds, globalSummits=summits, globalMaxElevation=summits.elevation.max())
+
+def test_disqualifier_due_north_at_the_inner_edge(tmp_path, monkeypatch):
+    monkeypatch.setattr(me, 'patchDirectory', str(tmp_path))
+
+    # The 3000 m summit is just in range of the candidate, and north of it by almost the whole offset
+    distance = 0.9995*(me.horizonDistance(1000) + me.horizonDistance(3000))
+    longitude, latitude, _ = me.geod.fwd(5, 59.9999, 0, distance)
+    summits = getSummits([59.9999, latitude, -40], [5, longitude, 100], [1000, 3000, 8700])
+
+    for bufferMode in ['global', 'adaptive']:
+        monkeypatch.setattr(me, 'patchBufferMode', bufferMode)
+        patch = makePatch(summits, (60, 50, 10, 0))
+        assert getPatchDisqualifiers(patch, summits) == {0: {1}}
+
+@pytest.mark.parametrize('patchBounds', [(60, 50, 10, 0), (80, 70, -170, -180), (-70, -80, 180, 170), (10, 0, -90, -100)])
+def test_adaptive_and_global_disqualifiers_match(tmp_path, monkeypatch, patchBounds):
+    monkeypatch.setattr(me, 'patchDirectory', str(tmp_path))
+
+    # Summits around the patch, mostly low with a few high ones, and Everest far away
+    northInner, southInner, _, _ = patchBounds
+    rng = np.random.default_rng(0)
+    numSummits = 20000
+    latitudes = rng.uniform(max(southInner - 15, -89), min(northInner + 15, 89), numSummits)
+    longitudes = rng.uniform(-180, 180, numSummits)
+    elevations = np.where(rng.random(numSummits) < 0.01, rng.uniform(3000, 6000, numSummits), rng.uniform(0, 1500, numSummits))
+    summits = getSummits(np.append(latitudes, 27.9892), np.append(longitudes, 86.9256), np.append(elevations, 8737.79))
+
+    patchDisqualifiers = {}
+    for bufferMode in ['global', 'adaptive']:
+        monkeypatch.setattr(me, 'patchBufferMode', bufferMode)
+        patchDisqualifiers[bufferMode] = getPatchDisqualifiers(makePatch(summits, patchBounds), summits)
+
+    assert len(patchDisqualifiers['global']) > 0
+    assert patchDisqualifiers['adaptive'] == patchDisqualifiers['global']
+
+    for summitId, disqualifiers in patchDisqualifiers['adaptive'].items():
+        summit = summits.loc[summitId]
+        observer = me.Summit(summit.latitude, summit.longitude, float(summit.elevation), summitId=summitId)
+        assert disqualifiers == getBruteForceDisqualifiers(observer, summits)
+
+@pytest.mark.parametrize('patchBounds', [(60, 50, 10, 0), (90, 80, None, None)])
+def test_npy_and_csv_patches_load_what_was_saved(tmp_path, monkeypatch, patchBounds):
+
+    rng = np.random.default_rng(1)
+    numSummits = 2000
+    summits = getSummits(rng.uniform(40, 90, numSummits), rng.uniform(-180, 180, numSummits), rng.uniform(0, 3000, numSummits))
+    summits = summits.astype(me.getSummitDtypes(summits.columns))
+
+    loadedPatches = {}
+    for patchFormat in ['npy', 'csv']:
+        monkeypatch.setattr(me, 'patchDirectory', str(tmp_path/patchFormat))
+        monkeypatch.setattr(me, 'patchFormat', patchFormat)
+        (tmp_path/patchFormat).mkdir()
+
+        patch = makePatch(summits, patchBounds)
+        loadedPatch = me.Patch(*patchBounds)
+
+        assert loadedPatch.summitsOuter is not None
+        assert loadedPatch.getMetadataDict() == patch.getMetadataDict()
+        assert dict(loadedPatch.summitsOuter.dtypes) == dict(patch.summitsOuter.dtypes)
+        loadedPatches[patchFormat] = loadedPatch
+
+    # Memory-mapped columns hold exactly the saved values, the csv holds them to its written precision
+    for column in patch.summitsOuter.columns:
+        assert np.array_equal(loadedPatches['npy'].summitsOuter[column], patch.summitsOuter[column])
+        assert np.allclose(loadedPatches['csv'].summitsOuter[column], patch.summitsOuter[column])
+
+@pytest.mark.parametrize('patchFormat', ['npy', 'csv'])
+def test_cached_patches_are_read_only(tmp_path, monkeypatch, patchFormat):
+    monkeypatch.setattr(me, 'patchDirectory', str(tmp_path))
+    monkeypatch.setattr(me, 'patchFormat', patchFormat)
+    monkeypatch.setattr(me, 'patchCache', me.OrderedDict())
+
+    summits = getSummits([55, 52, 58], [5, 6, 4], [1000, 2000, 1500])
+    makePatch(summits, (60, 50, 10, 0))
+    summitsOuter = me.getCachedPatch((60, 50, 10, 0)).summitsOuter
+
+    for column in summitsOuter.columns:
+        with pytest.raises(ValueError, match='read-only'):
+            summitsOuter.loc[0, column] = 0
@@ -0,0 +1,70 @@
+import types
+import numpy as np
+import pandas as pd
+import pytest
+import commons as me
+
+# A cone with a slope of 1 peaking at 2400 m, 20 km east of a 1950 m candidate on flat ground
+peakAzimuth = 90.125
+peakLongitude, peakLatitude, _ = me.geod.fwd(0, 0, peakAzimuth, 20000)
+
+fetchedSource = 'getElevations'
+
+def getFakeElevations(latitudes, longitudes):
+    return np.maximum(0, 2400 - me.getDistances(peakLatitude, peakLongitude, latitudes, longitudes))
+
+def getCandidate():
+    return me.Summit(0, 0, 1950, summitId=0)
+
+def getPatch(azimuths, distances, elevations):
+    longitudes, latitudes, _ = me.geod.fwd(np.zeros(len(azimuths)), np.zeros(len(azimuths)), azimuths, distances)
+    summits = pd.DataFrame({'summitId': np.arange(1, len(azimuths)+1),
+                            'latitude': latitudes,
+                            'longitude': longitudes,
+                            'elevation': np.array(elevations, dtype='float32')})
+    summits['maxHorizonDistance'] = me.horizonDistances(summits.elevation).astype('int32')
+
+    # isPinnaclePoint only reads summitsOuter from its patch
+    return types.SimpleNamespace(summitsOuter=summits)
+
+# A (3320 m) is hidden right behind the peak, B (3310 m) looks lower but its line passes 40 m beside the peak
+passingAzimuth = peakAzimuth + np.degrees(40/20000)
+
+@pytest.mark.parametrize('shadowTolerance', [0, 50])
+def test_summit_beside_a_shadow_is_still_tested(fetchedPoints, monkeypatch, shadowTolerance):
+    monkeypatch.setattr(me, 'disqualifierShadowTolerance', shadowTolerance)
+    patch = getPatch([peakAzimuth, passingAzimuth], [60000, 60000], [3320, 3310])
+
+    candidate = getCandidate()
+    assert not candidate.isPinnaclePoint(patch)
+    assert candidate.disqualifierId == 2
+
+def test_shadow_is_probed_first(fetchedPoints, monkeypatch):
+    # The second summit behind the peak is hidden, its probe at the peak finds that with a single sample
+    patch = getPatch([peakAzimuth, peakAzimuth], [60000, 59000], [3320, 3300])
+
+    numFetched = {}
+    for shadowTolerance in [0, 50]:
+        monkeypatch.setattr(me, 'disqualifierShadowTolerance', shadowTolerance)
+        fetchedPoints.clear()
+        assert getCandidate().isPinnaclePoint(patch)
+        numFetched[shadowTolerance] = len(fetchedPoints)
+
+    assert numFetched[50] < numFetched[0]
+
+def test_no_shadows_are_kept_without_probing(fetchedPoints, monkeypatch):
+    monkeypatch.setattr(me, 'disqualifierShadowTolerance', 0)
+    patch = getPatch([peakAzimuth, peakAzimuth], [60000, 59000], [3320, 3300])
+
+    def getNoObstructionPoints(self):
+        raise AssertionError('shadows are only worked out for probing')
+    monkeypatch.setattr(me.LineOfSightBatch, 'getObstructionPoints', getNoObstructionPoints)
+
+    assert getCandidate().isPinnaclePoint(patch)
+
+@pytest.mark.parametrize('disqualifierOrder', ['angle', 'distance'])
+def test_order_does_not_change_the_verdict(fetchedPoints, monkeypatch, disqualifierOrder):
+    monkeypatch.setattr(me, 'disqualifierOrder', disqualifierOrder)
+    patch = getPatch([peakAzimuth, passingAzimuth, 270], [60000, 60000, 30000], [3320, 3310, 2500])
+
+    assert not getCandidate().isPinnaclePoint(patch)
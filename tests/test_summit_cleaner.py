@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import commons as me
+
+cleanerFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'summit_cleaner.py')
+
+# The 2 summits whose OTOTW co-ords don't match, and Grove Hill
+manualCandidates = [[-10.8881, 27.5494], [47.1803, 7.305], [44.1381, -85.3444]]
+
+# The 2 iso summits listed far higher than they are
+isoElevationFixes = [[33.9233, 89.2108], [29.8958, -89.9983]]
+
+def writeRawLists(dataDirectory, isoElevationsFt):
+    rng = np.random.default_rng(0)
+    os.makedirs(dataDirectory / 'raw')
+    os.makedirs(dataDirectory / 'clean')
+
+    numPrmSummits = 3000
+    prmSummits = pd.DataFrame({'latitude': rng.uniform(-60, 70, numPrmSummits).round(4),
+                               'longitude': rng.uniform(-180, 180, numPrmSummits).round(4),
+                               'elevation': rng.integers(0, 40, numPrmSummits)*100.0, # Lots of ties
+                               'key_saddle_latitude': 0.0,
+                               'key_saddle_longitude': 0.0,
+                               'prominence': rng.uniform(100, 3000, numPrmSummits).round(4)})
+    prmSummits.loc[:10, 'longitude'] = 180.0
+    prmSummits.loc[20:22, ['latitude', 'longitude']] = manualCandidates
+
+    # Exact duplicates, and a row only different past float32 precision
+    prmSummits = pd.concat([prmSummits, prmSummits.iloc[100:400], prmSummits.iloc[[500]].assign(prominence=lambda summits: summits.prominence + 1e-6)])
+    prmSummits = prmSummits.sample(frac=1, random_state=1)
+    prmSummits.to_csv(dataDirectory / 'raw' / 'all-peaks-sorted-p100.txt', header=False, index=False)
+
+    ototw = prmSummits.sample(300, random_state=2)
+    pd.concat([ototw, ototw.head(5)]).to_csv(dataDirectory / 'raw' / 'ototw_p300m.csv', index=False)
+
+    numIsoSummits = len(isoElevationsFt)
+    isoSummits = pd.DataFrame({'latitude': rng.uniform(-60, 70, numIsoSummits).round(4),
+                               'longitude': rng.uniform(-180, 180, numIsoSummits).round(4),
+                               'elevation_ft': isoElevationsFt,
+                               'ILP_latitude': 0.0,
+                               'ILP_longitude': 0.0,
+                               'isolation_km': rng.uniform(0.5, 300, numIsoSummits).round(3)})
+    isoSummits.loc[:1, ['latitude', 'longitude']] = isoElevationFixes
+    isoSummits = pd.concat([isoSummits, isoSummits.iloc[:200]])
+    isoSummits.to_csv(dataDirectory / 'raw' / 'alliso-sorted.txt', header=False, index=False)
+
+    return prmSummits, ototw
+
+def getNoElevations(latitudes, longitudes):
+    return np.full(len(latitudes), np.nan)
+
+def runCleaner(tmp_path, monkeypatch, ingestChunkSize, outputChunkSize, getElevations=getNoElevations):
+    scriptsDirectory = tmp_path / 'scripts'
+    os.makedirs(scriptsDirectory, exist_ok=True)
+    monkeypatch.chdir(scriptsDirectory)
+
+    # Only the listed elevations by default, so the output does not depend on an elevation source
+    monkeypatch.setattr(me, 'getElevations', getElevations)
+
+    with open(cleanerFile) as cleaner:
+        source = cleaner.read()
+    for setting, value in [('ingestChunkSize', ingestChunkSize), ('outputChunkSize', outputChunkSize)]:
+        assert f'{setting} = 1000000' in source
+        source = source.replace(f'{setting} = 1000000', f'{setting} = {value}', 1)
+    exec(compile(source, cleanerFile, 'exec'), {'__name__': '__main__'})
+
+    return {name: pd.read_csv(tmp_path / 'data' / 'clean' / f'summits_{name}.csv') for name in ['prm', 'iso']}
+
+def getIsoElevationsFt():
+    return np.random.default_rng(3).permutation(np.arange(1000, 9000)).astype(float)
+
+def test_chunk_sizes_do_not_change_the_clean_lists(tmp_path, monkeypatch):
+    prmSummits, ototw = writeRawLists(tmp_path / 'data', getIsoElevationsFt())
+
+    cleanSummits = runCleaner(tmp_path, monkeypatch, ingestChunkSize=1000000, outputChunkSize=1000000)
+    for ingestChunkSize, outputChunkSize in [(1000, 700), (97, 13)]:
+        chunkedCleanSummits = runCleaner(tmp_path, monkeypatch, ingestChunkSize, outputChunkSize)
+        for name in ['prm', 'iso']:
+            pd.testing.assert_frame_equal(chunkedCleanSummits[name], cleanSummits[name])
+
+    # Same as the whole list cleaned in memory, ties in the order they were read
+    expectedSummits = prmSummits[['latitude', 'longitude', 'elevation', 'prominence']].drop_duplicates()
+    candidateCoordinates = set(zip(ototw.latitude, ototw.longitude)) | set(map(tuple, manualCandidates))
+    expectedSummits['candidate'] = [coordinates in candidateCoordinates for coordinates in zip(expectedSummits.latitude, expectedSummits.longitude)]
+    expectedSummits.loc[expectedSummits.longitude == 180.0, 'longitude'] -= 0.0001
+    expectedSummits = expectedSummits.sort_values('elevation', ascending=False, kind='stable').reset_index(drop=True)
+
+    prm = cleanSummits['prm']
+
+    # The row only different past float32 precision is not a duplicate, like with drop_duplicates
+    assert len(prm) == 3001
+    np.testing.assert_array_equal(prm.summitId, np.arange(len(expectedSummits)))
+    for column in ['latitude', 'longitude', 'elevation', 'candidate']:
+        np.testing.assert_array_equal(prm[column], expectedSummits[column])
+    np.testing.assert_allclose(prm.prominence, expectedSummits.prominence, rtol=1e-6)
+
+    # OTOTW rows listed twice do not repeat a summit, and the manual candidates are found by their coordinates
+    for latitude, longitude in manualCandidates:
+        matches = prm.query(f'latitude == {latitude} and longitude == {longitude}')
+        assert len(matches) == 1 and matches.candidate.all()
+
+@pytest.mark.parametrize('isoElevationsFt', [getIsoElevationsFt(), np.full(8000, 3000.0)])
+def test_elevation_fixes_find_summits_by_coordinates(tmp_path, monkeypatch, isoElevationsFt):
+    writeRawLists(tmp_path / 'data', isoElevationsFt)
+
+    # Not exactly representable as float32, like any DEM or decimal API elevation. The refresh never lowers a summit,
+    # so only the fixed summits end up at this elevation
+    cleanSummits = runCleaner(tmp_path, monkeypatch, ingestChunkSize=1000, outputChunkSize=700,
+                              getElevations=lambda latitudes, longitudes: np.full(len(latitudes), 123.3))
+
+    iso = cleanSummits['iso']
+    isFixed = iso.elevation.round(1) == 123.3
+    assert sorted(zip(iso.latitude[isFixed], iso.longitude[isFixed])) == sorted(map(tuple, isoElevationFixes))
+
+    # Fixed summits keep the place their listed elevation gave them, every other summit stays sorted
+    assert iso.elevation[isFixed].to_numpy(dtype='float32').tolist() == [np.float32(123.3)]*2
+    assert iso.elevation[~isFixed].is_monotonic_decreasing
+    assert (iso.index[isFixed] < len(iso) - 2).all()
+    assert (cleanSummits['prm'].elevation >= 123.3 - 1e-3).all()